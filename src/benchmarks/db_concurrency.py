@@ -0,0 +1,78 @@
+"""
+Benchmarks concurrent PostgreSQL queries under gevent, with and without
+the cooperative psycopg2 wait callback from identity.db.
+
+Spawns a number of greenlets, like gunicorn's --worker-connections, which
+each run a query that takes a fixed time on the server. When psycopg2
+blocks the event loop the queries run one after another; when it yields
+they overlap.
+
+Usage (from the src folder, with the usual environment variables set):
+
+    python -m benchmarks.db_concurrency --greenlets 10 --query-seconds 0.1
+"""
+from gevent import monkey; monkey.patch_all()  # noqa
+
+import time
+import argparse
+import gevent
+from psycopg2 import extensions
+from sqlalchemy import create_engine, text
+
+from identity.db import make_psycopg2_cooperative
+from identity.settings import DATABASE_URI
+
+
+parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+parser.add_argument('--greenlets', type=int, default=10, help='Number of concurrent greenlets')
+parser.add_argument('--queries', type=int, default=5, help='Number of queries per greenlet')
+parser.add_argument('--query-seconds', type=float, default=0.1, help='Time each query takes on the server')
+
+
+def run(greenlets, queries, query_seconds):
+    """
+    :param int greenlets:
+    :param int queries:
+    :param float query_seconds:
+    :return: Wall time in seconds
+    :rtype: float
+    """
+    engine = create_engine(DATABASE_URI, pool_size=greenlets)
+    statement = text('SELECT pg_sleep(:seconds)')
+
+    def worker():
+        for _ in range(queries):
+            with engine.connect() as conn:
+                conn.execute(statement, seconds=query_seconds)
+
+    # Open all connections up front, so connecting isn't measured
+    gevent.joinall([gevent.spawn(engine.connect().close) for _ in range(greenlets)])
+
+    started = time.perf_counter()
+    gevent.joinall([gevent.spawn(worker) for _ in range(greenlets)], raise_error=True)
+    elapsed = time.perf_counter() - started
+
+    engine.dispose()
+
+    return elapsed
+
+
+def main():
+    args = parser.parse_args()
+    total = args.greenlets * args.queries
+    results = {}
+
+    extensions.set_wait_callback(None)
+    results['blocking'] = run(args.greenlets, args.queries, args.query_seconds)
+
+    make_psycopg2_cooperative()
+    results['cooperative'] = run(args.greenlets, args.queries, args.query_seconds)
+
+    for mode, elapsed in results.items():
+        print(f'{mode:>12}: {total} queries in {elapsed:.2f} seconds '
+              f'({total / elapsed:.1f} queries/second)')
+
+    print(f'{"speedup":>12}: {results["blocking"] / results["cooperative"]:.1f}x')
+
+
+main()
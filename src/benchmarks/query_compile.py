@@ -0,0 +1,121 @@
+"""
+Micro-benchmark of the Python-side cost of the hot user lookups, comparing
+queries built and compiled on every call with the cached (baked) queries
+in UserRegistry.
+
+Runs against an in-memory SQLite database, so the numbers are dominated
+by SQLAlchemy's own overhead rather than the database.
+
+Usage (from the src folder, with the usual environment variables set):
+
+    python -m benchmarks.query_compile --iterations 10000
+"""
+import time
+import argparse
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import and_, create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+from identity.models import User, UserToken
+from identity.registry import registry
+
+
+parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+parser.add_argument('--iterations', type=int, default=10000, help='Number of lookups per shape')
+
+
+TOKEN = 'token'
+
+
+# Each shape of lookup, uncached and cached, given a session
+LOOKUPS = {
+    'subject': (
+        lambda session: session.query(User).filter_by(subject='subject').one_or_none(),
+        lambda session: registry._query_user(session=session, subject='subject'),
+    ),
+    'email': (
+        lambda session: session.query(User).filter_by(email='user@example.com').one_or_none(),
+        lambda session: registry._query_user(session=session, email='user@example.com'),
+    ),
+    'email+token': (
+        lambda session: session.query(User)
+            .join(UserToken, UserToken.user_id == User.id)
+            .filter(and_(
+                func.lower(User.email) == 'user@example.com',
+                UserToken.type == UserToken.RESET_PASSWORD,
+                UserToken.token_hash == registry._hash_token(TOKEN),
+                UserToken.expires > func.now(),
+            ))
+            .one_or_none(),
+        lambda session: registry.get_user_by_token(
+            'user@example.com', UserToken.RESET_PASSWORD, TOKEN, session=session),
+    ),
+    'credentials': (
+        lambda session: session.query(User)
+            .filter(
+                func.lower(User.email) == 'user@example.com',
+                User.active.is_(True),
+                User.disabled.is_(False),
+            )
+            .one_or_none(),
+        lambda session: registry._query_credentials('user@example.com', session=session),
+    ),
+}
+
+
+def measure(func, iterations):
+    """
+    :param typing.Callable func:
+    :param int iterations:
+    :return: Microseconds per call
+    :rtype: float
+    """
+    func()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main():
+    args = parser.parse_args()
+
+    engine = create_engine('sqlite://')
+    User.__table__.create(engine)
+    UserToken.__table__.create(engine)
+    session = sessionmaker(bind=engine)()
+    user = User(
+        subject='subject',
+        email='user@example.com',
+        password='password',
+        name='name',
+        company='company',
+        active=True,
+    )
+    session.add(user)
+    session.add(UserToken(
+        user=user,
+        type=UserToken.RESET_PASSWORD,
+        token_hash=registry._hash_token(TOKEN),
+        expires=datetime.now(tz=timezone.utc) + timedelta(hours=1),
+    ))
+    session.commit()
+
+    # The registry's lookups close the session after each lookup (when
+    # not given one), so do the same for both
+    def closing(lookup):
+        def closing_lookup():
+            try:
+                assert lookup(session) is not None
+            finally:
+                session.close()
+        return closing_lookup
+
+    for shape, (uncached_lookup, cached_lookup) in LOOKUPS.items():
+        uncached = measure(closing(uncached_lookup), args.iterations)
+        cached = measure(closing(cached_lookup), args.iterations)
+        print(f'{shape:>12}: {uncached:7.1f} us uncached, {cached:7.1f} us cached '
+              f'({uncached / cached:.1f}x)')
+
+
+main()
@@ -0,0 +1,9 @@
+from identity.metrics import metrics
+from identity.outbox import dispatcher
+from identity.settings import EMAIL_DISPATCH_METRICS_PORT
+
+
+if EMAIL_DISPATCH_METRICS_PORT:
+    metrics.serve(EMAIL_DISPATCH_METRICS_PORT)
+
+dispatcher.run_forever()
@@ -1,36 +1,101 @@
+import io
 import sys
 import csv
+import gzip
+import time
+import argparse
+import sqlalchemy as sa
+from datetime import datetime, timedelta
 
 from identity.models import User
 from identity.db import inject_session
 
 
+COLUMNS = (
+    User.id,
+    User.subject,
+    User.active,
+    User.name,
+    User.company,
+    User.email,
+    User.phone,
+)
+
+
+parser = argparse.ArgumentParser(description='Export users as CSV to stdout')
+parser.add_argument('--gzip', action='store_true', help='Compress the output with gzip')
+parser.add_argument('--chunk-size', type=int, default=1000, help='Number of rows to fetch from the database at a time')
+parser.add_argument('--since', type=datetime.fromisoformat, help='Only export users changed after this watermark (ISO 8601)')
+parser.add_argument('--settle-seconds', type=int, default=60, help='Leave out changes more recent than this, as they may not be committed yet')
+
+
 @inject_session
-def export_users_csv(session):
-
-    writer = csv.writer(sys.stdout)
-    writer.writerow((
-        'id',
-        'subject',
-        'active',
-        'name',
-        'company',
-        'email',
-        'phone',
-    ))
-
-    for user in session.query(User):
-        writer.writerow((
-            user.id,
-            user.subject,
-            user.active,
-            user.name,
-            user.company,
-            user.email,
-            user.phone,
-        ))
-
-    sys.stdout.flush()
-
-
-export_users_csv()
+def export_users_csv(compress, chunk_size, since, settle_seconds, session):
+    """
+    Streams the users through a server-side cursor, fetching only
+    the exported columns, so memory stays constant regardless of
+    the number of users.
+
+    If "since" is given, only users changed after this watermark are
+    exported. The watermark to use for the next export is printed to
+    stderr when done.
+
+    :param bool compress:
+    :param int chunk_size:
+    :param datetime since:
+    :param int settle_seconds:
+    :param Session session:
+    """
+    until = session.query(sa.func.now()).scalar() - timedelta(seconds=settle_seconds)
+
+    if compress:
+        stream = gzip.GzipFile(fileobj=sys.stdout.buffer, mode='wb')
+    else:
+        stream = sys.stdout.buffer
+
+    output = io.TextIOWrapper(stream, encoding='utf-8', newline='', write_through=False)
+    writer = csv.writer(output)
+    writer.writerow([c.key for c in COLUMNS])
+
+    query = session.query(*COLUMNS)
+
+    if since is not None:
+        query = query \
+            .filter(User.updated > since) \
+            .filter(User.updated <= until)
+
+    query = query \
+        .order_by(User.id) \
+        .execution_options(stream_results=True) \
+        .yield_per(chunk_size)
+
+    started = time.perf_counter()
+    count = 0
+
+    for row in query:
+        writer.writerow(row)
+        count += 1
+
+    output.flush()
+    output.detach()
+
+    if compress:
+        stream.close()
+
+    sys.stdout.buffer.flush()
+
+    elapsed = time.perf_counter() - started
+    print(f'Exported {count} users in {elapsed:.1f} seconds '
+          f'({count / elapsed if elapsed else 0:.0f} rows/second)',
+          file=sys.stderr)
+    print(f'Next watermark: {until.isoformat()}', file=sys.stderr)
+
+
+args = parser.parse_args()
+
+export_users_csv(
+    compress=args.gzip,
+    chunk_size=args.chunk_size,
+    since=args.since,
+    settle_seconds=args.settle_seconds,
+)
@@ -0,0 +1,266 @@
+import time
+import threading
+
+from .settings import (
+    ADMISSION_ROUTE_LIMITS,
+    ADMISSION_QUEUE_TIMEOUT,
+    ADMISSION_MAX_QUEUE,
+    ADMISSION_MAX_IN_FLIGHT,
+    ADMISSION_RETRY_AFTER,
+    ADMISSION_EXEMPT_ROUTES,
+)
+
+
+class Bulkhead(object):
+    """
+    Limits the number of concurrent requests to one route.
+
+    Requests beyond the limit wait (in a queue) for up to queue_timeout
+    seconds for a slot, after which they are rejected.
+
+    Under gevent the semaphore is patched to block only the waiting
+    greenlet, so waiting requests don't hold up other requests.
+    """
+
+    def __init__(self, name, limit, queue_timeout):
+        """
+        :param str name:
+        :param int limit: Max. number of concurrent requests
+        :param float queue_timeout: Max. seconds to wait for a slot
+        """
+        self.name = name
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.semaphore = threading.BoundedSemaphore(limit)
+
+        # Metrics
+        self.in_flight = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+
+    def try_acquire(self):
+        """
+        Takes a slot if one is free, without waiting.
+
+        :return: Whether the request was admitted
+        :rtype: bool
+        """
+        if not self.semaphore.acquire(blocking=False):
+            return False
+
+        self.in_flight += 1
+        self.admitted += 1
+        return True
+
+    def acquire(self):
+        """
+        Waits up to queue_timeout seconds for a slot.
+
+        :return: Whether the request was admitted
+        :rtype: bool
+        """
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        started = time.perf_counter()
+
+        try:
+            acquired = self.semaphore.acquire(timeout=self.queue_timeout)
+        finally:
+            self.queued -= 1
+            self.wait_seconds += time.perf_counter() - started
+
+        if not acquired:
+            self.rejected += 1
+            return False
+
+        self.in_flight += 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        self.semaphore.release()
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'max_queued': self.max_queued,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'wait_seconds': self.wait_seconds,
+        }
+
+
+class AdmissionController(object):
+    """
+    Decides whether to handle a request or reject it right away.
+
+    Expensive routes (ie. login, which hashes passwords, or clients,
+    which lists clients from Hydra) each get a bulkhead, so a burst on
+    one of them can not take all of the worker's connections and starve
+    the cheap routes. A bulkhead applies to an endpoint, or to one
+    method of an endpoint (ie. "login:POST", as GET only renders the
+    form).
+
+    Requests in flight are counted across all routes. When the worker
+    is handling max_in_flight requests, new requests to any route are
+    shed. Requests waiting for a bulkhead still hold a worker
+    connection, so when too many requests are waiting in total, new
+    requests to limited routes are shed instead of joining the queue.
+
+    To always leave room for the cheap routes, the sum of the route
+    limits and max_queue should be below max_in_flight.
+
+    Exempt routes (ie. static files and metrics) are always admitted
+    and not counted, so pages keep their assets and metrics can still
+    be scraped while requests are being shed.
+    """
+
+    def __init__(self, route_limits, queue_timeout, max_queue, max_in_flight,
+                 retry_after, exempt=()):
+        """
+        :param dict[str, int] route_limits: Concurrency limit per endpoint,
+            or per endpoint and method (ie. "login:POST")
+        :param float queue_timeout: Max. seconds to wait for a slot
+        :param int max_queue: Max. number of requests waiting in total,
+            0 for no limit
+        :param int max_in_flight: Max. number of requests in flight in
+            total, across all routes, 0 for no limit
+        :param int retry_after: Seconds clients are asked to wait before
+            retrying a rejected request
+        :param typing.Iterable[str] exempt: Endpoints which are never
+            limited or counted
+        """
+        self.exempt = frozenset(exempt)
+        self.max_queue = max_queue
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.bulkheads = {
+            route: Bulkhead(route, limit, queue_timeout)
+            for route, limit in route_limits.items()
+        }
+
+        # Metrics
+        self.in_flight = 0
+        self.max_in_flight_seen = 0
+        self.shed = 0
+
+    @property
+    def queued(self):
+        """
+        Number of requests currently waiting for a bulkhead.
+
+        :rtype: int
+        """
+        return sum(b.queued for b in self.bulkheads.values())
+
+    def bulkhead(self, endpoint, method):
+        """
+        Returns the bulkhead of the endpoint and method, if limited.
+
+        :param str endpoint:
+        :param str method:
+        :rtype: Bulkhead
+        """
+        return self.bulkheads.get(f'{endpoint}:{method}') \
+            or self.bulkheads.get(endpoint)
+
+    def admit(self, endpoint, method):
+        """
+        Admits or rejects a request. Admitted requests must call
+        release() when done.
+
+        :param str endpoint:
+        :param str method:
+        :return: Whether the request was admitted
+        :rtype: bool
+        """
+        if endpoint in self.exempt:
+            return True
+
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            self.shed += 1
+            return False
+
+        bulkhead = self.bulkhead(endpoint, method)
+
+        self.in_flight += 1
+        self.max_in_flight_seen = max(self.max_in_flight_seen, self.in_flight)
+
+        if bulkhead is None or bulkhead.try_acquire():
+            return True
+
+        # Checked right before joining the queue, with no switch to
+        # other greenlets in between
+        if self.max_queue and self.queued >= self.max_queue:
+            self.shed += 1
+            self.in_flight -= 1
+            return False
+
+        if bulkhead.acquire():
+            return True
+
+        self.in_flight -= 1
+        return False
+
+    def release(self, endpoint, method):
+        """
+        :param str endpoint:
+        :param str method:
+        """
+        if endpoint in self.exempt:
+            return
+
+        self.in_flight -= 1
+        bulkhead = self.bulkhead(endpoint, method)
+
+        if bulkhead is not None:
+            bulkhead.release()
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight_seen,
+            'queued': self.queued,
+            'shed': self.shed,
+            'rejected': self.shed + sum(b.rejected for b in self.bulkheads.values()),
+            'routes': {name: b.stats() for name, b in self.bulkheads.items()},
+        }
+
+
+def parse_route_limits(value):
+    """
+    Parses route limits on the form "login:POST=4,clients=2".
+
+    :param str value:
+    :rtype: dict[str, int]
+    """
+    limits = {}
+
+    for item in value.split(','):
+        if item.strip():
+            route, limit = item.split('=')
+            limits[route.strip()] = int(limit)
+
+    return limits
+
+
+admission = AdmissionController(
+    route_limits=parse_route_limits(ADMISSION_ROUTE_LIMITS),
+    queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+    max_queue=ADMISSION_MAX_QUEUE,
+    max_in_flight=ADMISSION_MAX_IN_FLIGHT,
+    retry_after=ADMISSION_RETRY_AFTER,
+    exempt=[e.strip() for e in ADMISSION_EXEMPT_ROUTES.split(',') if e.strip()],
+)
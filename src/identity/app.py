@@ -1,13 +1,15 @@
+import time
 import logging
 import os
 
-from flask import Flask, send_from_directory
+from flask import Flask, Response, g, request, send_from_directory
+from jinja2 import Template
 from flask_wtf.csrf import CSRFProtect
+from werkzeug.middleware.proxy_fix import ProxyFix
 from opencensus.trace import config_integration
 from opencensus.ext.azure.log_exporter import AzureLogHandler
 from opencensus.ext.azure.trace_exporter import AzureExporter
 from opencensus.ext.flask.flask_middleware import FlaskMiddleware
-from opencensus.trace.samplers import AlwaysOnSampler
 
 from .settings import (
     SECRET,
@@ -15,6 +17,32 @@ from .settings import (
     STATIC_DIR,
     AZURE_APP_INSIGHTS_CONN_STRING,
     PROJECT_NAME,
+    TRUSTED_PROXY_COUNT,
+    METRICS_ENABLED,
+    TRACE_SAMPLING_RATE,
+    TRACE_SAMPLING_ROUTE_RATES,
+    TRACE_SAMPLING_MODE,
+    TRACE_SLOW_THRESHOLD_MS,
+    TRACE_TAIL_MAX_PENDING,
+    TRACE_EXPORT_QUEUE_SIZE,
+)
+from .db import engine, remove_session, round_trips
+from .admission import admission
+from .audit import audit_log
+from .hashing import hashing_pool, password_hasher
+from .hydra import hydra
+from .metrics import metrics
+from .profiler import profiler
+from . import timing
+from .registry import registry
+from .throttle import login_throttle
+from .watchdog import watchdog
+from .tracing import (
+    RouteSampler,
+    QueueExporter,
+    SampledFlagPropagator,
+    TailSamplingExporter,
+    parse_route_rates,
 )
 from .controllers import (
     login,
@@ -32,6 +60,7 @@ from .controllers import (
     revoke_consent,
     show_oauth2_clients,
     delete_client,
+    show_metrics,
 )
 
 # Import models here for SQLAlchemy to detect them
@@ -56,6 +85,11 @@ app.logger.setLevel(logging.DEBUG)
 app.config['SECRET_KEY'] = SECRET
 
 
+# Behind a reverse proxy, take the client's IP from X-Forwarded-For
+if TRUSTED_PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
+
+
 if AZURE_APP_INSIGHTS_CONN_STRING:
     print('Exporting logs to Azure Application Insight', flush=True)
 
@@ -71,19 +105,182 @@ if AZURE_APP_INSIGHTS_CONN_STRING:
     handler.setLevel(logging.DEBUG)
     app.logger.addHandler(handler)
 
-    exporter = AzureExporter(connection_string=AZURE_APP_INSIGHTS_CONN_STRING)
-    exporter.add_telemetry_processor(__telemetry_processor)
+    azure_exporter = AzureExporter(connection_string=AZURE_APP_INSIGHTS_CONN_STRING)
+    azure_exporter.add_telemetry_processor(__telemetry_processor)
+
+    # Exports from a bounded queue in its own background thread, so
+    # exporting adds no latency to requests
+    exporter = QueueExporter(
+        exporter=azure_exporter,
+        max_size=TRACE_EXPORT_QUEUE_SIZE,
+    )
+    metrics.register_stats('trace_export', exporter.stats)
+
+    sampler = RouteSampler(
+        rate=TRACE_SAMPLING_RATE,
+        route_rates=parse_route_rates(TRACE_SAMPLING_ROUTE_RATES),
+        tail=TRACE_SAMPLING_MODE == 'tail',
+    )
+
+    if sampler.tail:
+        exporter = TailSamplingExporter(
+            exporter=exporter,
+            sampler=sampler,
+            slow_seconds=TRACE_SLOW_THRESHOLD_MS / 1000,
+            max_pending=TRACE_TAIL_MAX_PENDING,
+        )
+        metrics.register_stats('trace_tail_sampling', exporter.stats)
 
     FlaskMiddleware(
         app=app,
-        sampler=AlwaysOnSampler(),
+        sampler=sampler,
         exporter=exporter,
+        propagator=SampledFlagPropagator(sampler),
     )
 
 
+# -- Metrics -----------------------------------------------------------------
+
+
+REQUEST_SECONDS = metrics.histogram(
+    'request_duration_seconds',
+    'Latency of requests per route, method and response status',
+    labels=('route', 'method', 'status'),
+)
+
+TEMPLATE_RENDER_SECONDS = metrics.histogram(
+    'template_render_duration_seconds',
+    'Time spent rendering templates',
+    labels=('template',),
+)
+
+
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        with TEMPLATE_RENDER_SECONDS.time(template=self.name), timing.phase('render'):
+            return super(TimedTemplate, self).render(*args, **kwargs)
+
+
+app.jinja_env.template_class = TimedTemplate
+
+metrics.register_stats('db_pool', engine.pool.stats)
+metrics.register_stats('db_round_trips', round_trips.stats, label='flow')
+metrics.register_stats('hashing_pool', hashing_pool.stats)
+metrics.register_stats('hydra_transport', hydra.transport.stats)
+metrics.register_stats('hydra_clients', hydra.clients.stats)
+metrics.register_stats('hydra_login_requests_cache', hydra.login_requests.stats)
+metrics.register_stats('hydra_consent_requests_cache', hydra.consent_requests.stats)
+metrics.register_stats('user_cache', registry.cache.stats)
+metrics.register_stats('admission', admission.stats)
+metrics.register_stats('login_throttle', login_throttle.stats)
+metrics.register_stats('audit_log', audit_log.stats)
+metrics.register_stats('profiler', profiler.stats)
+metrics.register_stats('event_loop_watchdog', watchdog.stats)
+
+
+# Registered first, so requests are timed even if they are rejected
+# by admission control
+@app.before_request
+def __start_timing_request():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def __record_response_status(response):
+    g.response_status = response.status_code
+
+    if timing.ENABLED and 'request_started' in g:
+        timing.report(response, time.perf_counter() - g.request_started)
+
+    return response
+
+
+# Teardown functions run in reverse order, so this runs last
+@app.teardown_request
+def __time_request(exception=None):
+    started = g.pop('request_started', None)
+    if started is not None:
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            route=request.endpoint or 'none',
+            method=request.method,
+            status=g.pop('response_status', 500),
+        )
+
+
+# -- Admission control -------------------------------------------------------
+
+
+# Registered before CSRF protection, so rejected requests are turned
+# away before doing any work
+@app.before_request
+def __admit_request():
+    if not admission.admit(request.endpoint, request.method):
+        return Response(
+            'The service is busy, please try again',
+            status=503,
+            headers={'Retry-After': str(admission.retry_after)},
+        )
+    g.admitted = True
+
+
+# Teardown functions run in reverse order, so the request's slot is
+# released after everything else has been cleaned up
+@app.teardown_request
+def __release_request(exception=None):
+    if g.pop('admitted', False):
+        admission.release(request.endpoint, request.method)
+
+
+# -- Profiling ---------------------------------------------------------------
+
+
+@app.before_request
+def __start_profile():
+    profile = profiler.start(request.headers.get(profiler.HEADER))
+    if profile is not None:
+        g.profile = profile
+
+
+@app.after_request
+def __finish_profile(response):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        filename = profiler.finish(profile, request.endpoint or 'none')
+        if filename:
+            response.headers[profiler.HEADER] = filename
+    return response
+
+
+# In case the request failed before after_request() was called
+@app.teardown_request
+def __finish_failed_profile(exception=None):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profiler.finish(profile, request.endpoint or 'none')
+
+
 csrf = CSRFProtect(app)
 
 
+# Teardown functions run in reverse order, so round trips are counted
+# after the session has been removed
+@app.teardown_request
+def __count_round_trips(exception=None):
+    round_trips.finish(request.endpoint)
+
+
+app.teardown_request(remove_session)
+
+
+# Pick the cost of password hashing for the hardware we are running on
+password_hasher.calibrate()
+
+
+# Started after calibrating, which blocks the event loop on purpose
+watchdog.start()
+
+
 # -- URLs/routes setup -------------------------------------------------------
 
 
@@ -101,5 +298,9 @@ app.add_url_rule('/disable-user', 'disable-user', disable_user, methods=['GET',
 app.add_url_rule('/revoke-consent', 'revoke-consent', revoke_consent, methods=['GET', 'POST'])
 app.add_url_rule('/clients', 'clients', show_oauth2_clients, methods=['GET', 'POST'])
 app.add_url_rule('/clients/delete', 'delete-client', delete_client, methods=['GET'])
+
+if METRICS_ENABLED:
+    app.add_url_rule('/metrics', 'metrics', show_metrics, methods=['GET'])
+
 app.register_error_handler(404, error_handler)
 app.register_error_handler(500, error_handler)
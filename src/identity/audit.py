@@ -0,0 +1,260 @@
+import atexit
+import logging
+import threading
+from collections import deque
+from datetime import date, datetime, timezone
+
+from .db import engine, atomic
+from .models import AuditEvent
+from .settings import (
+    PROJECT_NAME,
+    AUDIT_LOG_BATCH_SIZE,
+    AUDIT_LOG_FLUSH_INTERVAL,
+    AUDIT_LOG_MAX_BUFFER,
+)
+
+
+logger = logging.getLogger(f'{PROJECT_NAME}.audit')
+
+
+class AuditLog(object):
+    """
+    Append-only log of authentication events (logins, registrations,
+    password changes etc.).
+
+    Events are buffered in memory and written by a background thread in
+    multi-row inserts, when the buffer reaches the batch size or after
+    the flush interval, whichever comes first. Recording an event never
+    touches the database, so it adds nothing to the request.
+
+    If the database is unavailable, events are kept in the buffer up to
+    its max. size, after which the oldest are dropped (and counted).
+    """
+
+    # Event types
+    LOGIN_SUCCEEDED = 'login_succeeded'
+    LOGIN_FAILED = 'login_failed'
+    REGISTERED = 'registered'
+    PASSWORD_CHANGED = 'password_changed'
+    DISABLED = 'disabled'
+
+    def __init__(self, batch_size, flush_interval, max_buffer):
+        """
+        :param int batch_size: Max. number of events per insert
+        :param float flush_interval: Max. seconds an event is buffered
+        :param int max_buffer: Max. number of events to keep in memory
+        """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = deque(maxlen=max_buffer)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+        # Metrics
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.inserts = 0
+        self.errors = 0
+        self.missing_partition_errors = 0
+
+        atexit.register(self.flush)
+
+    def record(self, event, subject=None, email=None, ip=None, **details):
+        """
+        Adds an event to the buffer.
+
+        :param str event: One of the event types on this class
+        :param str subject:
+        :param str email:
+        :param str ip:
+        :param details: Additional JSON-serializable details
+        """
+        row = {
+            'created': datetime.now(tz=timezone.utc),
+            'event': event,
+            'subject': subject,
+            'email': email,
+            'ip': ip,
+            'details': details or None,
+        }
+
+        with self._lock:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append(row)
+            self.recorded += 1
+            full = len(self.buffer) >= self.batch_size
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_forever, daemon=True)
+            self._thread.start()
+
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Writes all buffered events to the database, one batch at a time.
+        """
+        while True:
+            with self._lock:
+                batch = [self.buffer.popleft()
+                         for _ in range(min(self.batch_size, len(self.buffer)))]
+
+            if not batch:
+                return
+
+            try:
+                engine.execute(AuditEvent.__table__.insert().values(batch))
+            except Exception as e:
+                if _is_missing_partition(e):
+                    logger.error(
+                        f'Failed to write {len(batch)} audit events, as there is no '
+                        f'partition for them. Is maintain_audit_partitions.py running?')
+                    self.missing_partition_errors += 1
+                else:
+                    logger.exception(f'Failed to write {len(batch)} audit events')
+                self.errors += 1
+                self._requeue(batch)
+                return
+            else:
+                self.inserts += 1
+                self.written += len(batch)
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'buffered': len(self.buffer),
+            'recorded': self.recorded,
+            'written': self.written,
+            'dropped': self.dropped,
+            'inserts': self.inserts,
+            'errors': self.errors,
+            'missing_partition_errors': self.missing_partition_errors,
+        }
+
+    def _requeue(self, batch):
+        """
+        Puts a failed batch back in front of the buffer, as far as
+        there is room for it.
+
+        :param list[dict] batch:
+        """
+        with self._lock:
+            room = self.buffer.maxlen - len(self.buffer)
+            self.dropped += max(0, len(batch) - room)
+            self.buffer.extendleft(reversed(batch[:room]))
+
+    def _flush_forever(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+# -- Partitions --------------------------------------------------------------
+
+
+def partition_name(month):
+    """
+    :param date month: First day of the month
+    :rtype: str
+    """
+    return f'audit_event_{month:%Y_%m}'
+
+
+def add_months(month, count):
+    """
+    :param date month: First day of the month
+    :param int count:
+    :rtype: date
+    """
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+@atomic
+def create_partitions(months_ahead, session):
+    """
+    Creates the monthly partitions of audit_event from the current month
+    and the given number of months ahead, if they don't exist already.
+
+    :param int months_ahead:
+    :param Session session:
+    :return: Names of the partitions created
+    :rtype: list[str]
+    """
+    existing = set(_list_partitions(session))
+    this_month = date.today().replace(day=1)
+    created = []
+
+    for i in range(months_ahead + 1):
+        month = add_months(this_month, i)
+        name = partition_name(month)
+
+        if name not in existing:
+            session.execute(
+                f'CREATE TABLE {name} PARTITION OF audit_event '
+                f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')")
+            created.append(name)
+
+    return created
+
+
+@atomic
+def drop_partitions(retention_months, session):
+    """
+    Drops the monthly partitions of audit_event which only hold events
+    older than the given number of months.
+
+    :param int retention_months:
+    :param Session session:
+    :return: Names of the partitions dropped
+    :rtype: list[str]
+    """
+    cutoff = partition_name(add_months(date.today().replace(day=1), -retention_months))
+    dropped = []
+
+    for name in sorted(_list_partitions(session)):
+        if name < cutoff:
+            session.execute(f'ALTER TABLE audit_event DETACH PARTITION {name}')
+            session.execute(f'DROP TABLE {name}')
+            dropped.append(name)
+
+    return dropped
+
+
+def _is_missing_partition(error):
+    """
+    Returns whether an insert failed because no partition of audit_event
+    covers the events.
+
+    :param Exception error:
+    :rtype: bool
+    """
+    return 'no partition of relation' in str(error)
+
+
+def _list_partitions(session):
+    """
+    :param Session session:
+    :rtype: list[str]
+    """
+    rows = session.execute(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+        "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+        "WHERE parent.relname = 'audit_event'")
+
+    return [row[0] for row in rows]
+
+
+audit_log = AuditLog(
+    batch_size=AUDIT_LOG_BATCH_SIZE,
+    flush_interval=AUDIT_LOG_FLUSH_INTERVAL,
+    max_buffer=AUDIT_LOG_MAX_BUFFER,
+)
@@ -0,0 +1,79 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    A bounded in-process cache where entries expire after a fixed
+    number of seconds, and where the least recently used entry is
+    evicted when the cache is full.
+
+    No operation yields to other greenlets, so the cache is safe to
+    share between greenlets without locking.
+    """
+
+    def __init__(self, maxsize, ttl):
+        """
+        :param int maxsize: Max. number of entries to keep
+        :param float ttl: Number of seconds to keep each entry
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        :param typing.Hashable key:
+        :param typing.Any default:
+        :rtype: typing.Any
+        """
+        entry = self.entries.get(key)
+
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        """
+        :param typing.Hashable key:
+        :param typing.Any value:
+        """
+        if self.maxsize <= 0:
+            return
+
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, key):
+        """
+        :param typing.Hashable key:
+        """
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
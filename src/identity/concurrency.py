@@ -0,0 +1,32 @@
+import threading
+
+
+def is_gevent_patched(module='threading'):
+    """
+    Returns whether gevent has monkey-patched the given standard
+    library module, ie. when running in gunicorn's gevent worker.
+
+    :param str module:
+    :rtype: bool
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched(module)
+
+
+def native_lock():
+    """
+    Returns a lock which is safe to share between greenlets and native
+    threads (ie. the hashing pool's), even when gevent has patched
+    threading. Holding it blocks the whole thread, so it must only
+    guard short sections which never yield to other greenlets.
+
+    :rtype: threading.Lock
+    """
+    if is_gevent_patched():
+        from gevent.monkey import get_original
+        return get_original('threading', 'Lock')()
+
+    return threading.Lock()
@@ -1,10 +1,15 @@
 import jwt
+import math
 from datetime import datetime, timezone
 
-from flask import request, render_template, redirect, url_for, make_response
+from flask import request, render_template, redirect, url_for, make_response, Response
 
+from identity.db import unit_of_work
+from identity.audit import audit_log, AuditLog
+from identity.models import UserToken
 from identity.registry import registry
-from identity.email import email_service
+from identity.throttle import login_throttle
+from identity.metrics import metrics, CONTENT_TYPE
 from identity.forms import (
     LoginForm,
     RegisterForm,
@@ -36,6 +41,7 @@ from identity.hydra import (
 TOKEN_COOKIE_NAME = 'token'
 
 LOGIN_ERROR_MSG = 'The email / password combination is not correct'
+LOGIN_THROTTLED_MSG = 'Too many login attempts, please try again later'
 EMAIL_ERROR_MSG = 'E-mail was not recognized'
 VERIFICATION_CODE_ERROR_MSG = 'Wrong verification code'
 VERIFICATION_CODE_EMAIL_ERROR_MSG = 'Wrong e-mail or verification code'
@@ -61,9 +67,15 @@ def register():
             email=form.email.data,
             phone=form.phone.data,
             password=form.password.data,
+            challenge=challenge,
         )
 
-        email_service.send_welcome_email(user, challenge)
+        audit_log.record(
+            AuditLog.REGISTERED,
+            subject=user.subject,
+            email=user.email,
+            ip=request.remote_addr,
+        )
 
         complete = True
         # return redirect(url_for('login', login_challenge=challenge))
@@ -77,6 +89,7 @@ def register():
     return render_template('register.html', **env)
 
 
+@unit_of_work
 def verify_email():
     """
     TODO
@@ -84,7 +97,6 @@ def verify_email():
     challenge = request.args.get('challenge')
     email = request.args.get('email')
     activate_token = request.args.get('activate_token')
-    user = registry.get_user(email=email, activate_token=activate_token)
 
     if not challenge:
         raise Exception("No challenge in form")
@@ -92,6 +104,9 @@ def verify_email():
         raise Exception("No email in args")
     if not activate_token:
         raise Exception("No activate_token in args")
+
+    user = registry.get_user_by_token(email, UserToken.ACTIVATE, activate_token)
+
     if not user:
         raise Exception("User not found")
 
@@ -107,6 +122,7 @@ def login():
     form = LoginForm()
     challenge = request.args.get('login_challenge')
     error = None
+    retry_after = 0
 
     if not challenge:
         raise Exception("No challenge in form")
@@ -115,6 +131,13 @@ def login():
 
     # Already logged in (remembered)?
     if login_request.skip:
+        audit_log.record(
+            AuditLog.LOGIN_SUCCEEDED,
+            subject=login_request.subject,
+            ip=request.remote_addr,
+            remembered=True,
+        )
+
         res = hydra.accept_login(challenge, LoginAccept(
             subject=login_request.subject,
             remember=login_request.skip,
@@ -129,15 +152,35 @@ def login():
 
     # Login form submitted and validated correctly?
     if form.validate_on_submit():
-        user = registry.authenticate(
-            email=form.email.data,
-            password=form.password.data,
-        )
+        retry_after = login_throttle.check(form.email.data, request.remote_addr)
+
+        # Too many attempts are turned away before hashing the password
+        if retry_after:
+            user = None
+        else:
+            user = registry.authenticate(
+                email=form.email.data,
+                password=form.password.data,
+            )
 
         # Authentication successful?
-        if user is None:
+        if retry_after:
+            error = LOGIN_THROTTLED_MSG
+        elif user is None:
+            audit_log.record(
+                AuditLog.LOGIN_FAILED,
+                email=form.email.data,
+                ip=request.remote_addr,
+            )
             error = LOGIN_ERROR_MSG
         else:
+            audit_log.record(
+                AuditLog.LOGIN_SUCCEEDED,
+                subject=user.subject,
+                email=user.email,
+                ip=request.remote_addr,
+            )
+
             res = hydra.accept_login(challenge, LoginAccept(
                 subject=user.subject,
                 remember=form.remember.data,
@@ -157,6 +200,10 @@ def login():
         'reset_password_url': url_for('reset-password', challenge=challenge),
     }
 
+    if retry_after:
+        headers = {'Retry-After': str(math.ceil(retry_after))}
+        return render_template('login.html', **env), 429, headers
+
     return render_template('login.html', **env)
 
 
@@ -271,8 +318,7 @@ def reset_password():
         if user is None:
             error = EMAIL_ERROR_MSG
         else:
-            registry.assign_reset_password_token(user)
-            email_service.send_reset_password_email(user, challenge)
+            registry.assign_reset_password_token(user, challenge)
 
             return redirect(url_for(
                 'enter-verification-code',
@@ -313,11 +359,11 @@ def enter_verification_code():
         raise Exception("No email in args")
     if not user:
         raise Exception("User not found")
-    if user.reset_password_token is None:
+    if not registry.has_token(user, UserToken.RESET_PASSWORD):
         raise Exception("User has no reset token")
 
     if form.is_submitted() or form.verification_code.data.strip():
-        if user.reset_password_token != form.verification_code.data.strip():
+        if not registry.check_token(user, UserToken.RESET_PASSWORD, form.verification_code.data.strip()):
             error = VERIFICATION_CODE_ERROR_MSG
         else:
             return redirect(url_for(
@@ -355,18 +401,23 @@ def change_password():
     if not verification_code:
         raise Exception("No verification_code in args")
 
-    user = registry.get_user(
-        email=email,
-        reset_password_token=verification_code,
-    )
+    user = registry.get_user_by_token(
+        email, UserToken.RESET_PASSWORD, verification_code)
 
-    if user is None or user.reset_password_token is None:
+    if user is None:
         error = VERIFICATION_CODE_EMAIL_ERROR_MSG
     elif form.validate_on_submit():
         if form.password1.data != form.password2.data:
             error = PASSWORD_CHANGE_DID_NOT_MATCH
         else:
             registry.assign_password(user, form.password1.data)
+            audit_log.record(
+                AuditLog.PASSWORD_CHANGED,
+                subject=user.subject,
+                email=user.email,
+                ip=request.remote_addr,
+                via='reset-password',
+            )
             complete = True
 
     env = {
@@ -405,9 +456,7 @@ def edit_profile():
         form.phone.data = user.phone
 
     def __validate_change_password():
-        hashed_current_password = registry.password_hash(
-            form.current_password.data)
-        if hashed_current_password != user.password:
+        if not registry.check_password(user, form.current_password.data):
             return PASSWORD_CHANGE_CURRENT_PASSWORD_INCORRECT
         elif form.password1.data != form.password2.data:
             return PASSWORD_CHANGE_DID_NOT_MATCH
@@ -424,14 +473,27 @@ def edit_profile():
             password_error = __validate_change_password()
 
         if not password_error:
-            if is_changing_password:
-                registry.assign_password(user, form.password1.data)
+            # Only the changes run as a unit of work, so no transaction
+            # is open while checking the password, calling Hydra or
+            # rendering
+            with unit_of_work():
+                if is_changing_password:
+                    registry.assign_password(user, form.password1.data)
+
+                registry.update_details(user, **{
+                    'name': form.name.data,
+                    'company': form.company.data,
+                    'phone': form.phone.data,
+                })
 
-            registry.update_details(user, **{
-                'name': form.name.data,
-                'company': form.company.data,
-                'phone': form.phone.data,
-            })
+            if is_changing_password:
+                audit_log.record(
+                    AuditLog.PASSWORD_CHANGED,
+                    subject=user.subject,
+                    email=user.email,
+                    ip=request.remote_addr,
+                    via='edit-profile',
+                )
 
             return redirect(return_url)
 
@@ -466,6 +528,12 @@ def disable_user():
     if form.is_submitted():
         if form.disable.data:
             registry.disable_user(user)
+            audit_log.record(
+                AuditLog.DISABLED,
+                subject=user.subject,
+                email=user.email,
+                ip=request.remote_addr,
+            )
             return redirect(f'{return_url}?&disable=1')
         else:
             return redirect(return_url)
@@ -532,11 +600,8 @@ def show_oauth2_clients():
 
         return redirect(url_for('clients', return_url=return_url))
 
-    clients = hydra.get_oauth2_clients()
-    clients_filtered = [c for c in clients if c['owner'] == subject]
-
     env = {
-        'clients': clients_filtered,
+        'clients': hydra.get_oauth2_clients_by_owner(subject),
         'return_url': return_url,
         'create_client_form': create_client_form,
         'delete_client_url': url_for('delete-client', return_url=return_url),
@@ -560,14 +625,11 @@ def delete_client():
     if not return_url:
         raise Exception("No return_url in args")
 
-    # All clients owned by all users
-    all_clients = hydra.get_oauth2_clients()
+    # Ownership is checked against Hydra itself, as the in-process index
+    # of clients may be stale
+    client = hydra.get_oauth2_client(client_id)
 
-    # All clients owned by current subject
-    users_clients = [c for c in all_clients if c['owner'] == subject]
-    users_clients_mapped = {c['client_id']: c for c in users_clients}
-
-    if client_id in users_clients_mapped:
+    if client is not None and client.get('owner') == subject:
         hydra.delete_oauth2_client(client_id)
 
     response = make_response(redirect(url_for('clients', return_url=return_url)))
@@ -585,6 +647,15 @@ def terms():
     return render_template('terms.html')
 
 
+def show_metrics():
+    """
+    Metrics in the Prometheus text exposition format.
+
+    :rtype: flask.Response
+    """
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+
 def error_handler(e=None):
     """
     :rtype: flask.Response
@@ -1,15 +1,279 @@
-from sqlalchemy import create_engine
+import time
+import logging
+import traceback
+from contextlib import contextmanager
+from greenlet import getcurrent
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import sessionmaker, scoped_session, configure_mappers
 from sqlalchemy.ext.declarative import declarative_base
 
-from .settings import DATABASE_URI, SQL_ALCHEMY_SETTINGS
+from .concurrency import is_gevent_patched
+from .metrics import metrics, FAST_BUCKETS
+from . import timing
+from .settings import (
+    DATABASE_URI,
+    SQL_ALCHEMY_SETTINGS,
+    DATABASE_COOPERATIVE,
+    DATABASE_POOL_PRE_PING,
+    DATABASE_POOL_PING_IDLE_SECONDS,
+    DATABASE_LEAK_DETECTION,
+    PROJECT_NAME,
+)
+
+
+logger = logging.getLogger(f'{PROJECT_NAME}.db')
+
+
+DB_QUERY_SECONDS = metrics.histogram(
+    'db_query_duration_seconds',
+    'Time spent executing statements, per kind of statement',
+    labels=('statement',),
+    buckets=FAST_BUCKETS,
+)
+
+DB_POOL_WAIT_SECONDS = metrics.histogram(
+    'db_pool_checkout_wait_seconds',
+    'Time spent waiting for a connection from the pool',
+    buckets=FAST_BUCKETS,
+)
+
+
+def gevent_wait_callback(conn, timeout=None):
+    """
+    Wait callback for psycopg2 which yields to other greenlets while
+    waiting for PostgreSQL, instead of blocking the whole event loop.
+    """
+    from psycopg2 import extensions, OperationalError
+    from gevent.socket import wait_read, wait_write
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise OperationalError(f'Bad result from poll: {state}')
+
+
+def make_psycopg2_cooperative():
+    """
+    Installs gevent_wait_callback() for all psycopg2 connections
+    created from now on.
+    """
+    from psycopg2 import extensions
+    extensions.set_wait_callback(gevent_wait_callback)
+
+
+if DATABASE_COOPERATIVE == 'auto':
+    if is_gevent_patched('socket'):
+        make_psycopg2_cooperative()
+elif DATABASE_COOPERATIVE in ('1', 't', 'true', 'yes'):
+    make_psycopg2_cooperative()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    A QueuePool which measures how long checkouts wait for a connection,
+    and counts overflow connections and checkout timeouts.
+
+    Only the public connect() is wrapped, so the wait includes the
+    "checkout" events (ie. pinging idle connections). Overflow
+    connections are counted by the "connect" event below.
+    """
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.overflows = 0
+        self.timeouts = 0
+
+    def connect(self):
+        started = time.perf_counter()
+
+        try:
+            return super(InstrumentedQueuePool, self).connect()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_POOL_WAIT_SECONDS.observe(elapsed)
+            self.checkouts += 1
+            self.wait_seconds += elapsed
+            self.max_wait_seconds = max(self.max_wait_seconds, elapsed)
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'size': self.size(),
+            'checked_out': self.checkedout(),
+            'checked_in': self.checkedin(),
+            'overflow': max(self.overflow(), 0),
+            'checkouts': self.checkouts,
+            'wait_seconds': self.wait_seconds,
+            'max_wait_seconds': self.max_wait_seconds,
+            'avg_wait_seconds': self.wait_seconds / self.checkouts if self.checkouts else 0.0,
+            'overflows': self.overflows,
+            'timeouts': self.timeouts,
+        }
+
+
+engine = create_engine(
+    DATABASE_URI,
+    poolclass=InstrumentedQueuePool,
+    **SQL_ALCHEMY_SETTINGS
+)
+
+
+@event.listens_for(engine, 'connect')
+def __on_connect(dbapi_connection, connection_record):
+    """
+    Counts new connections opened beyond the size of the pool.
+    """
+    if engine.pool.overflow() > 0:
+        engine.pool.overflows += 1
+
+
+if DATABASE_POOL_PRE_PING == 'idle':
+    @event.listens_for(engine, 'checkin')
+    def __on_checkin(dbapi_connection, connection_record):
+        connection_record.info['checked_in'] = time.monotonic()
+
+    @event.listens_for(engine, 'checkout')
+    def __on_checkout(dbapi_connection, connection_record, connection_proxy):
+        """
+        Pings connections which have been idle for a while before
+        handing them out. A dead connection is discarded, and the
+        pool retries with a new one.
+        """
+        checked_in = connection_record.info.get('checked_in')
+        idle = time.monotonic() - checked_in if checked_in else 0
+
+        if idle > DATABASE_POOL_PING_IDLE_SECONDS:
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            except Exception:
+                raise exc.DisconnectionError()
+            finally:
+                cursor.close()
+
+
+# Connections currently checked out of the pool, when leak detection is
+# enabled: {id(connection_record): (greenlet, stack at checkout)}
+checked_out = {}
+
+
+if DATABASE_LEAK_DETECTION:
+    @event.listens_for(engine, 'checkout')
+    def __track_checkout(dbapi_connection, connection_record, connection_proxy):
+        checked_out[id(connection_record)] = (getcurrent(), traceback.format_stack())
+
+    @event.listens_for(engine, 'checkin')
+    def __track_checkin(dbapi_connection, connection_record):
+        checked_out.pop(id(connection_record), None)
+
+
+class RoundTripCounter(object):
+    """
+    Counts the statements, commits and rollbacks sent to the database
+    by each greenlet, and aggregates them per flow (ie. per view) when
+    the flow finishes.
+    """
+
+    KINDS = ('statements', 'commits', 'rollbacks')
+
+    def __init__(self):
+        self.current = {}
+        self.flows = {}
+
+    def count(self, kind):
+        """
+        :param str kind:
+        """
+        counts = self.current.setdefault(getcurrent(), dict.fromkeys(self.KINDS, 0))
+        counts[kind] += 1
+
+    def finish(self, flow):
+        """
+        Adds the current greenlet's counts to the totals of the flow.
+
+        :param str flow:
+        """
+        counts = self.current.pop(getcurrent(), dict.fromkeys(self.KINDS, 0))
+        totals = self.flows.setdefault(flow, dict.fromkeys(('runs',) + self.KINDS, 0))
+        totals['runs'] += 1
+
+        for kind in self.KINDS:
+            totals[kind] += counts[kind]
+
+    def stats(self):
+        """
+        Returns the average number of round trips per run of each flow.
+
+        :rtype: dict
+        """
+        return {
+            flow: {
+                'runs': totals['runs'],
+                **{kind: totals[kind] / totals['runs'] for kind in self.KINDS},
+            }
+            for flow, totals in self.flows.items()
+        }
+
+
+round_trips = RoundTripCounter()
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def __count_statement(conn, cursor, statement, parameters, context, executemany):
+    round_trips.count('statements')
+    conn.info.setdefault('statements_started', []).append(time.perf_counter())
+
+
+@event.listens_for(engine, 'after_cursor_execute')
+def __time_statement(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['statements_started'].pop()
+    kind = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else ''
+
+    if kind not in ('select', 'insert', 'update', 'delete'):
+        kind = 'other'
+
+    DB_QUERY_SECONDS.observe(elapsed, statement=kind)
+    timing.add('db', elapsed)
+
+
+@event.listens_for(engine, 'handle_error')
+def __discard_statement(context):
+    started = context.connection.info.get('statements_started') if context.connection else None
+    if started:
+        started.pop()
+
+
+@event.listens_for(engine, 'commit')
+def __count_commit(conn):
+    round_trips.count('commits')
+
+
+@event.listens_for(engine, 'rollback')
+def __count_rollback(conn):
+    round_trips.count('rollbacks')
 
 
-engine = create_engine(DATABASE_URI, **SQL_ALCHEMY_SETTINGS)
 configure_mappers()
 ModelBase = declarative_base()
 factory = sessionmaker(bind=engine, expire_on_commit=False)
-Session = scoped_session(factory)
+
+# Sessions are scoped to the current greenlet (or thread, when not
+# running under gevent), and removed at the end of each request
+Session = scoped_session(factory, scopefunc=getcurrent)
 
 
 def make_session(*args, **kwargs):
@@ -21,6 +285,104 @@ def make_session(*args, **kwargs):
     return Session(*args, **kwargs)
 
 
+def remove_session(exception=None):
+    """
+    Removes the current greenlet's session, returning its connection
+    to the pool. Registered to run when each request ends.
+
+    With leak detection enabled, connections still checked out by the
+    current greenlet at this point are reported along with the stack
+    which checked them out.
+    """
+    if DATABASE_LEAK_DETECTION:
+        current = getcurrent()
+
+        for owner, stack in list(checked_out.values()):
+            if owner is current:
+                logger.warning(
+                    'Database connection held past the end of the request, '
+                    'checked out at:\n' + ''.join(stack))
+
+        if Session.registry.has():
+            session = Session.registry()
+            if session.new or session.dirty or session.deleted:
+                logger.warning('Session has uncommitted changes at the end of the request')
+
+    Session.remove()
+
+
+def current_unit_of_work():
+    """
+    Returns the session of the unit of work the current greenlet
+    is running in, if any.
+
+    :rtype: Session
+    """
+    if Session.registry.has():
+        session = Session.registry()
+        if session.info.get('unit_of_work'):
+            return session
+
+
+def after_unit_of_work(func, *args):
+    """
+    Calls func(*args) when the current unit of work has ended (committed
+    or rolled back), or right away if not in a unit of work.
+    """
+    session = current_unit_of_work()
+
+    if session is None:
+        func(*args)
+    else:
+        session.info['callbacks'].append((func, args))
+
+
+def unit_of_work(func=None):
+    """
+    Runs a function (ie. a view) or a block of code as one unit of work.
+    Sessions injected by inject_session() and atomic() within it all use
+    the same session, connection and transaction, which is committed
+    when it ends, or rolled back if it raises an exception.
+
+    Use it as a function decorator, or as a context manager:
+
+        with unit_of_work():
+            ...
+
+    The transaction holds a pooled connection from the first statement
+    until the unit ends, so keep password hashing, requests to Hydra
+    and rendering outside of it.
+    """
+    if func is None:
+        return _unit_of_work()
+
+    def unit_of_work_wrapper(*args, **kwargs):
+        with _unit_of_work():
+            return func(*args, **kwargs)
+
+    return unit_of_work_wrapper
+
+
+@contextmanager
+def _unit_of_work():
+    _session = make_session()
+    _session.info['unit_of_work'] = True
+    _session.info['callbacks'] = []
+    try:
+        yield _session
+    except:
+        _session.rollback()
+        raise
+    else:
+        _session.commit()
+    finally:
+        callbacks = _session.info.pop('callbacks')
+        _session.info.pop('unit_of_work')
+        _session.close()
+        for callback, callback_args in callbacks:
+            callback(*callback_args)
+
+
 def inject_session(func):
     """
     Function decorator which injects a "session" named parameter
@@ -31,7 +393,8 @@ def inject_session(func):
         try:
             return func(*args, **kwargs)
         finally:
-            _session.close()
+            if not _session.info.get('unit_of_work'):
+                _session.close()
 
     return session_wrapper
 
@@ -45,6 +408,13 @@ def atomic(func):
     @inject_session
     def atomic_wrapper(*args, **kwargs):
         _session = kwargs['session']
+
+        # Within a unit of work, the unit commits or rolls back
+        if _session.info.get('unit_of_work'):
+            return_value = func(*args, **kwargs)
+            _session.flush()
+            return return_value
+
         try:
             return_value = func(*args, **kwargs)
         except:
@@ -1,12 +1,20 @@
-import sendgrid
+import os
+import smtplib
+from abc import ABCMeta, abstractmethod
+import requests
+from uuid import uuid4
+from requests.adapters import HTTPAdapter
+from email.message import EmailMessage
 from sendgrid.helpers.mail import Email, Content, Mail, To
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urlparse
 
-from .models import User
+from .models import User, OutboxEmail
 from .settings import (
     EMAIL_FROM_NAME,
     EMAIL_FROM_ADDRESS,
+    EMAIL_TRANSPORT,
     SENDGRID_API_KEY,
+    SENDGRID_TIMEOUT,
     PROJECT_URL)
 
 
@@ -28,28 +36,203 @@ To reset your password, click or copy/paste this link in your browser to reset y
 
 Your verification code is:
 
-%(reset_password_token)s
+%(verification_code)s
 """
 
 
-class EmailService(object):
+# -- Transports --------------------------------------------------------------
+
+
+class EmailTransport(object, metaclass=ABCMeta):
+    """
+    Base class for e-mail transports.
+
+    A transport is created once per process and reused for every
+    e-mail, so subclasses can hold on to connections between sends.
+    The e-mail dispatcher measures the sends per transport (name).
+    """
+
+    name = None
+
+    @abstractmethod
+    def send(self, email):
+        """
+        :param OutboxEmail email:
+        """
 
-    @property
-    def client(self):
+
+class SendGridTransport(EmailTransport):
+    """
+    Sends e-mails through SendGrid's v3 API using a single keep-alive
+    HTTP session, so consecutive e-mails reuse the same connection.
+    """
+
+    name = 'sendgrid'
+
+    URL = 'https://api.sendgrid.com/v3/mail/send'
+
+    def __init__(self, api_key, timeout):
         """
-        :rtype: sendgrid.SendGridAPIClient
+        :param str api_key:
+        :param float timeout:
         """
-        return sendgrid.SendGridAPIClient(api_key=SENDGRID_API_KEY)
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.headers.update({
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json',
+        })
 
-    def send_welcome_email(self, user, challenge):
+    def send(self, email):
+        """
+        :param OutboxEmail email:
+        """
+        from_email = Email(EMAIL_FROM_ADDRESS, EMAIL_FROM_NAME)
+        to_email = To(email.recipient)
+        content = Content('text/plain', email.body)
+        mail = Mail(from_email, to_email, email.subject, content)
+
+        response = self.session.post(self.URL, json=mail.get(), timeout=self.timeout)
+        response.raise_for_status()
+
+
+class SmtpTransport(EmailTransport):
+    """
+    Sends e-mails through a plain SMTP server, ie. a local debugging
+    server like "python -m smtpd -n -c DebuggingServer localhost:1025".
+
+    The SMTP connection is kept open between e-mails. If sending over
+    it fails, it is closed and the e-mail is sent once more over a new
+    connection, as the old one may be unusable (ie. closed by the server
+    or reset, or left in a broken state by an error response).
+    """
+
+    name = 'smtp'
+
+    def __init__(self, host, port):
+        """
+        :param str host:
+        :param int port:
+        """
+        self.host = host
+        self.port = port
+        self.smtp = None
+
+    def send(self, email):
+        """
+        :param OutboxEmail email:
+        """
+        message = _build_message(email)
+
+        if self.smtp is not None:
+            try:
+                self.smtp.send_message(message)
+                return
+            except (smtplib.SMTPException, OSError):
+                self._close()
+
+        try:
+            self.smtp = smtplib.SMTP(self.host, self.port)
+            self.smtp.send_message(message)
+        except (smtplib.SMTPException, OSError):
+            self._close()
+            raise
+
+    def _close(self):
+        """
+        Closes the connection, if any, ignoring errors as it may
+        already be broken.
+        """
+        if self.smtp is not None:
+            try:
+                self.smtp.close()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
+
+
+class FileTransport(EmailTransport):
+    """
+    Writes e-mails as .eml files to a local (spool) directory
+    instead of sending them.
+    """
+
+    name = 'file'
+
+    def __init__(self, directory):
+        """
+        :param str directory:
+        """
+        self.directory = directory
+
+    def send(self, email):
+        """
+        :param OutboxEmail email:
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{uuid4()}.eml')
+
+        with open(path, 'wb') as f:
+            f.write(_build_message(email).as_bytes())
+
+
+def _build_message(email):
+    """
+    :param OutboxEmail email:
+    :rtype: EmailMessage
+    """
+    message = EmailMessage()
+    message['From'] = f'{EMAIL_FROM_NAME} <{EMAIL_FROM_ADDRESS}>'
+    message['To'] = email.recipient
+    message['Subject'] = email.subject
+    message.set_content(email.body)
+    return message
+
+
+def create_transport(uri):
+    """
+    Creates a transport from a URI, one of:
+
+        sendgrid
+        smtp://host:port
+        file:///path/to/directory
+
+    :param str uri:
+    """
+    parsed = urlparse(uri)
+
+    if parsed.scheme == 'smtp':
+        return SmtpTransport(parsed.hostname, parsed.port or 25)
+    elif parsed.scheme == 'file':
+        return FileTransport(parsed.path)
+    elif uri == 'sendgrid':
+        return SendGridTransport(SENDGRID_API_KEY, SENDGRID_TIMEOUT)
+    else:
+        raise ValueError(f'Unknown e-mail transport: {uri}')
+
+
+# -- Service -----------------------------------------------------------------
+
+
+class EmailService(object):
+    """
+    Composes e-mails and puts them in the outbox. E-mails are written
+    using the caller's database session, so they are only sent if the
+    caller's transaction commits. The e-mail dispatcher sends them.
+    """
+
+    def queue_welcome_email(self, user, token, challenge, session):
         """
         :param User user:
+        :param str token: The activation token
         :param str challenge:
+        :param Session session:
         """
         query = urlencode({
             'email': user.email,
             'challenge': challenge,
-            'activate_token': user.activate_token,
+            'activate_token': token,
         })
 
         env = {
@@ -58,43 +241,38 @@ class EmailService(object):
             'company': user.company,
         }
 
-        body = WELCOME_TEMPLATE % env
-
-        from_email = Email(EMAIL_FROM_ADDRESS, EMAIL_FROM_NAME)
-        to_email = To(user.email)
-        subject = 'Activate your account'
-        content = Content('text/plain', body)
-        mail = Mail(from_email, to_email, subject, content)
-
-        self.client.client.mail.send.post(request_body=mail.get())
+        session.add(OutboxEmail(
+            recipient=user.email,
+            subject='Activate your account',
+            body=WELCOME_TEMPLATE % env,
+        ))
 
-    def send_reset_password_email(self, user, challenge):
+    def queue_reset_password_email(self, user, token, challenge, session):
         """
         :param User user:
+        :param str token: The reset password token
         :param str challenge:
+        :param Session session:
         """
         query = urlencode({
             'email': user.email,
             'challenge': challenge,
-            'verification_code': user.reset_password_token,
+            'verification_code': token,
         })
 
         env = {
             'url': f'{PROJECT_URL}/enter-verification-code?{query}',
             'name': user.name,
             'company': user.company,
-            'reset_password_token': user.reset_password_token,
+            'verification_code': token,
         }
 
-        body = RESET_PASSWORD_TEMPLATE % env
-
-        from_email = Email(EMAIL_FROM_ADDRESS, EMAIL_FROM_NAME)
-        to_email = To(user.email)
-        subject = 'Reset password'
-        content = Content('text/plain', body)
-        mail = Mail(from_email, to_email, subject, content)
-
-        self.client.client.mail.send.post(request_body=mail.get())
+        session.add(OutboxEmail(
+            recipient=user.email,
+            subject='Reset password',
+            body=RESET_PASSWORD_TEMPLATE % env,
+        ))
 
 
 email_service = EmailService()
+email_transport = create_transport(EMAIL_TRANSPORT)
@@ -0,0 +1,290 @@
+import os
+import hmac
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .concurrency import is_gevent_patched
+from .metrics import metrics
+from . import timing
+from .settings import (
+    PROJECT_NAME,
+    SECRET,
+    PASSWORD_HASH_POOL_SIZE,
+    PASSWORD_HASH_BUDGET_MS,
+    PASSWORD_HASH_MIN_ITERATIONS,
+    PASSWORD_HASH_ITERATIONS,
+    PASSWORD_HASH_REHASH_TOLERANCE,
+)
+
+
+logger = logging.getLogger(f'{PROJECT_NAME}.hashing')
+
+
+PASSWORD_HASH_SECONDS = metrics.histogram(
+    'password_hash_duration_seconds',
+    'Time spent hashing passwords, including waiting for the pool',
+    labels=('operation',),
+)
+
+
+def _timed(func, args):
+    started = time.perf_counter()
+    return started, func(*args)
+
+
+class HashingPool(object):
+    """
+    Runs CPU-heavy functions, like password hashing, in a bounded pool
+    of native threads.
+
+    Under gevent the calling greenlet yields to the hub while waiting
+    for the result, so other greenlets keep running while a hash is
+    computed. hashlib releases the GIL while hashing, so the work runs
+    in parallel with the rest of the worker.
+
+    All counters are updated by the calling greenlet, never by the
+    pool's threads.
+    """
+
+    def __init__(self, size):
+        """
+        :param int size: Max. number of concurrently running functions
+        """
+        self.size = size
+        self.in_flight = 0
+        self.max_queue_depth = 0
+        self.calls = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.run_seconds = 0.0
+        self._pool = None
+
+    @property
+    def queue_depth(self):
+        """
+        Number of calls waiting for a free thread.
+
+        :rtype: int
+        """
+        return max(0, self.in_flight - self.size)
+
+    def apply(self, func, *args):
+        """
+        Runs func(*args) in the pool and returns its result.
+
+        :param typing.Callable func:
+        :rtype: typing.Any
+        """
+        submitted = time.perf_counter()
+        self.in_flight += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+        try:
+            started, result = self._run(_timed, func, args)
+        finally:
+            self.in_flight -= 1
+
+        finished = time.perf_counter()
+        wait = started - submitted
+
+        self.calls += 1
+        self.wait_seconds += wait
+        self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        self.run_seconds += finished - started
+
+        return result
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'size': self.size,
+            'in_flight': self.in_flight,
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'calls': self.calls,
+            'wait_seconds': self.wait_seconds,
+            'max_wait_seconds': self.max_wait_seconds,
+            'avg_wait_seconds': self.wait_seconds / self.calls if self.calls else 0.0,
+            'run_seconds': self.run_seconds,
+        }
+
+    def _run(self, *args):
+        if self._pool is None:
+            if is_gevent_patched():
+                from gevent.threadpool import ThreadPool
+                self._pool = ThreadPool(self.size)
+            else:
+                self._pool = ThreadPoolExecutor(self.size)
+
+        if isinstance(self._pool, ThreadPoolExecutor):
+            return self._pool.submit(*args).result()
+        else:
+            return self._pool.apply(args[0], args[1:])
+
+
+class PasswordHasher(object):
+    """
+    Hashes and verifies passwords.
+
+    Hashes are stored as "<algorithm>$<iterations>$<salt>$<hash>", so
+    each hash carries its own salt and cost. Hashes without a "$" are of
+    the legacy format: PBKDF2-SHA512 with the application SECRET as salt
+    and a fixed number of iterations.
+
+    Unless pinned, the number of iterations is calibrated on the current
+    hardware so that one hash costs roughly the configured CPU budget.
+    """
+
+    ALGORITHM = 'pbkdf2_sha512'
+    LEGACY_ITERATIONS = 100000
+    CALIBRATION_ITERATIONS = 20000
+    CALIBRATION_ROUNDS = 3
+    ITERATIONS_STEP = 10000
+
+    def __init__(self, pool, budget_ms, min_iterations, iterations=None,
+                 rehash_tolerance=0.25):
+        """
+        :param HashingPool pool:
+        :param float budget_ms: Target CPU time per hash in milliseconds
+        :param int min_iterations: Never hash with fewer iterations
+        :param int iterations: Fixed number of iterations (skips calibration)
+        :param float rehash_tolerance: Relative deviation from the current
+            number of iterations before a hash is considered stale
+        """
+        self.pool = pool
+        self.budget_ms = budget_ms
+        self.min_iterations = min_iterations
+        self.rehash_tolerance = rehash_tolerance
+        self._iterations = iterations
+        self._dummy = None
+
+    @property
+    def iterations(self):
+        """
+        :rtype: int
+        """
+        if self._iterations is None:
+            self.calibrate()
+        return self._iterations
+
+    def calibrate(self):
+        """
+        Measures the cost of hashing on the current hardware and picks
+        the number of iterations which meets the CPU budget.
+        """
+        if self._iterations is not None:
+            return
+
+        elapsed = min(
+            self._time_hash(self.CALIBRATION_ITERATIONS)
+            for _ in range(self.CALIBRATION_ROUNDS)
+        )
+
+        iterations = self.CALIBRATION_ITERATIONS * (self.budget_ms / 1000) / elapsed
+        iterations = int(iterations // self.ITERATIONS_STEP * self.ITERATIONS_STEP)
+
+        self._iterations = max(iterations, self.min_iterations)
+
+        logger.info(
+            f'Calibrated password hashing to {self._iterations} iterations '
+            f'({elapsed * 1000:.1f} ms per {self.CALIBRATION_ITERATIONS} iterations)'
+        )
+
+    def hash(self, password):
+        """
+        :param str password:
+        :rtype: str
+        """
+        iterations = self.iterations
+        salt = os.urandom(16).hex()
+
+        with PASSWORD_HASH_SECONDS.time(operation='hash'), timing.phase('hash'):
+            digest = self._pbkdf2(password, salt, iterations)
+
+        return f'{self.ALGORITHM}${iterations}${salt}${digest}'
+
+    def verify(self, password, encoded):
+        """
+        :param str password:
+        :param str encoded:
+        :rtype: bool
+        """
+        if '$' not in encoded:
+            with PASSWORD_HASH_SECONDS.time(operation='verify'), timing.phase('hash'):
+                digest = self._pbkdf2(password, SECRET, self.LEGACY_ITERATIONS)
+            return hmac.compare_digest(digest, encoded)
+
+        algorithm, iterations, salt, expected = encoded.split('$', 3)
+
+        if algorithm != self.ALGORITHM:
+            raise ValueError(f'Unknown password hash algorithm: {algorithm}')
+
+        with PASSWORD_HASH_SECONDS.time(operation='verify'), timing.phase('hash'):
+            digest = self._pbkdf2(password, salt, int(iterations))
+
+        return hmac.compare_digest(digest, expected)
+
+    def verify_dummy(self, password):
+        """
+        Verifies the password against a hash which nothing matches, at
+        the current number of iterations. Used when there is no user to
+        check the password of, so that costs the same as when there is,
+        and the response time doesn't reveal which e-mails are registered.
+
+        :param str password:
+        :rtype: bool
+        """
+        iterations = self.iterations
+
+        if self._dummy is None or self._dummy[0] != iterations:
+            salt = os.urandom(16).hex()
+            self._dummy = (iterations, f'{self.ALGORITHM}${iterations}${salt}${"0" * 128}')
+
+        self.verify(password, self._dummy[1])
+        return False
+
+    def needs_rehash(self, encoded):
+        """
+        :param str encoded:
+        :rtype: bool
+        """
+        if '$' not in encoded:
+            return True
+
+        algorithm, iterations, _ = encoded.split('$', 2)
+        iterations = int(iterations)
+
+        return (
+            algorithm != self.ALGORITHM
+            or iterations < self.min_iterations
+            or abs(iterations - self.iterations) > self.iterations * self.rehash_tolerance
+        )
+
+    def _pbkdf2(self, password, salt, iterations):
+        return self.pool.apply(
+            hashlib.pbkdf2_hmac,
+            'sha512',
+            password.encode('utf-8'),
+            salt.encode('utf-8'),
+            iterations,
+        ).hex()
+
+    def _time_hash(self, iterations):
+        started = time.perf_counter()
+        hashlib.pbkdf2_hmac('sha512', b'calibration', os.urandom(16), iterations)
+        return time.perf_counter() - started
+
+
+hashing_pool = HashingPool(PASSWORD_HASH_POOL_SIZE)
+
+password_hasher = PasswordHasher(
+    pool=hashing_pool,
+    budget_ms=PASSWORD_HASH_BUDGET_MS,
+    min_iterations=PASSWORD_HASH_MIN_ITERATIONS,
+    iterations=PASSWORD_HASH_ITERATIONS,
+    rehash_tolerance=PASSWORD_HASH_REHASH_TOLERANCE,
+)
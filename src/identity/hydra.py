@@ -1,15 +1,49 @@
 import json
-
+import time
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
 from marshmallow import EXCLUDE
-from requests import get, put, post, delete
 from dataclasses import dataclass
 from typing import List, Dict
 from marshmallow_dataclass import class_schema
 from datetime import datetime
-from urllib.parse import urlencode
+from urllib.parse import urlencode, quote
 
+from identity.cache import TTLCache
+from identity.metrics import metrics
+from identity import timing
 from identity.scopes import SCOPES
-from identity.settings import HYDRA_URL, HYDRA_WANTED_SCOPES
+from identity.settings import (
+    PROJECT_NAME,
+    HYDRA_URL,
+    HYDRA_WANTED_SCOPES,
+    HYDRA_POOL_SIZE,
+    HYDRA_CONNECT_TIMEOUT,
+    HYDRA_READ_TIMEOUT,
+    HYDRA_KEEP_ALIVE,
+    HYDRA_REQUEST_CACHE_SIZE,
+    HYDRA_REQUEST_CACHE_TTL,
+    HYDRA_CLIENT_PAGE_SIZE,
+    HYDRA_CLIENT_INDEX_REFRESH,
+)
+
+
+logger = logging.getLogger(f'{PROJECT_NAME}.hydra')
+
+
+HYDRA_REQUEST_SECONDS = metrics.histogram(
+    'hydra_request_duration_seconds',
+    'Latency of requests to Hydra per call',
+    labels=('call',),
+)
+
+HYDRA_REQUESTS = metrics.counter(
+    'hydra_requests_total',
+    'Requests to Hydra per call and response status ("error" if no response)',
+    labels=('call', 'status'),
+)
 
 
 @dataclass
@@ -178,18 +212,244 @@ class HydraException(Exception):
     pass
 
 
+@dataclass
+class CallStats:
+    calls: int = 0
+    errors: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+
+class HydraTransport:
+    """
+    Long-lived HTTP transport for talking to Hydra's admin API.
+
+    Holds a single requests.Session with a bounded, keep-alive connection
+    pool, so consecutive calls reuse the same TCP/TLS connections instead
+    of doing a new handshake per call. The pool blocks when all
+    connections are in use, which is cooperative under gevent's
+    monkey-patching.
+    """
+    def __init__(self, pool_size, connect_timeout, read_timeout, keep_alive=True):
+        self.timeout = (connect_timeout, read_timeout)
+        self.adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            pool_block=True,
+        )
+        self.session = requests.Session()
+        self.session.verify = False
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.calls = {}
+
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+    def request(self, name, method, url, **kwargs):
+        """
+        :param str name: Name of the operation, used for statistics
+        :param str method:
+        :param str url:
+        :rtype: requests.Response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        stats = self.calls.setdefault(name, CallStats())
+        status = 'error'
+        started = time.perf_counter()
+
+        try:
+            response = self.session.request(method, url, **kwargs)
+            status = response.status_code
+            return response
+        except requests.RequestException:
+            stats.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            stats.calls += 1
+            stats.total_seconds += elapsed
+            stats.max_seconds = max(stats.max_seconds, elapsed)
+            HYDRA_REQUEST_SECONDS.observe(elapsed, call=name)
+            HYDRA_REQUESTS.inc(call=name, status=status)
+            timing.add('hydra', elapsed)
+
+    def stats(self):
+        """
+        Returns per-call latency counters and the connection reuse rate,
+        ie. the fraction of requests which did not need a new connection.
+
+        :rtype: dict
+        """
+        requests_total = 0
+        connections_total = 0
+        pools = self.adapter.poolmanager.pools
+
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests_total += pool.num_requests
+                connections_total += pool.num_connections
+
+        if requests_total:
+            reuse_rate = 1 - connections_total / requests_total
+        else:
+            reuse_rate = 0.0
+
+        return {
+            'requests': requests_total,
+            'connections': connections_total,
+            'reuse_rate': reuse_rate,
+            'calls': {
+                name: {
+                    'calls': s.calls,
+                    'errors': s.errors,
+                    'total_seconds': s.total_seconds,
+                    'max_seconds': s.max_seconds,
+                    'avg_seconds': s.total_seconds / s.calls if s.calls else 0.0,
+                }
+                for name, s in self.calls.items()
+            },
+        }
+
+
+class OAuth2ClientIndex:
+    """
+    In-process index of OAuth2 clients by their owner (subject).
+
+    The index is built by streaming through all clients in Hydra the
+    first time it is used, and is rebuilt periodically in a background
+    thread afterwards to pick up changes made elsewhere. Clients created
+    or deleted through this service are applied to the index right away.
+    """
+    def __init__(self, load, refresh_interval):
+        """
+        :param typing.Callable[[], typing.Iterable[dict]] load:
+        :param float refresh_interval:
+        """
+        self.load = load
+        self.refresh_interval = refresh_interval
+        self.by_owner = None
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self._lock = threading.Lock()
+        self._pending = None
+        self._thread = None
+
+    def get(self, owner):
+        """
+        :param str owner:
+        :rtype: list[dict]
+        """
+        if self.by_owner is None or self._thread is None:
+            with self._lock:
+                if self.by_owner is None:
+                    self._rebuild()
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._refresh_forever, daemon=True)
+                    self._thread.start()
+
+        return list(self.by_owner.get(owner, {}).values())
+
+    def add(self, client):
+        """
+        :param dict client:
+        """
+        self._apply(self._add, client)
+
+    def remove(self, client_id):
+        """
+        :param str client_id:
+        """
+        self._apply(self._remove, client_id)
+
+    def refresh(self):
+        """
+        Rebuilds the index from scratch. Changes applied while the
+        rebuild is in progress are replayed on top of the new index.
+        """
+        with self._lock:
+            self._rebuild()
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        by_owner = self.by_owner or {}
+
+        return {
+            'owners': len(by_owner),
+            'clients': sum(len(c) for c in by_owner.values()),
+            'refreshes': self.refreshes,
+            'refresh_errors': self.refresh_errors,
+        }
+
+    def _rebuild(self):
+        self._pending = []
+        try:
+            by_owner = {}
+            for client in self.load():
+                self._add(client, by_owner)
+            for func, arg in self._pending:
+                func(arg, by_owner)
+            self.by_owner = by_owner
+            self.refreshes += 1
+        finally:
+            self._pending = None
+
+    def _apply(self, func, arg):
+        if self._pending is not None:
+            self._pending.append((func, arg))
+        if self.by_owner is not None:
+            func(arg, self.by_owner)
+
+    def _add(self, client, by_owner):
+        by_owner.setdefault(client['owner'], {})[client['client_id']] = client
+
+    def _remove(self, client_id, by_owner):
+        for clients in by_owner.values():
+            clients.pop(client_id, None)
+
+    def _refresh_forever(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception:
+                self.refresh_errors += 1
+                logger.exception('Failed to refresh OAuth2 client index')
+
+
 class Hydra:
-    def __init__(self, url):
+    def __init__(self, url, transport, request_cache_size, request_cache_ttl,
+                 client_page_size, client_index_refresh):
         self.url = url
+        self.transport = transport
+        self.client_page_size = client_page_size
+        self.clients = OAuth2ClientIndex(
+            load=self.iter_oauth2_clients,
+            refresh_interval=client_index_refresh,
+        )
+
+        # Parsed login/consent requests keyed by their challenge.
+        # An entry is dropped once its challenge is accepted or rejected.
+        self.login_requests = TTLCache(request_cache_size, request_cache_ttl)
+        self.consent_requests = TTLCache(request_cache_size, request_cache_ttl)
 
     def get_login_request(self, challenge: str) -> LoginRequest:
+        login_request = self.login_requests.get(challenge)
+        if login_request is not None:
+            return login_request
+
         url = f'{self.url}/oauth2/auth/requests/login'
         params = {'login_challenge': challenge}
 
-        response = get(url, params=params, verify=False)
+        response = self.transport.request('get_login_request', 'GET', url, params=params)
 
         if response.status_code == 200:
-            return login_request_schema.loads(response.content)
+            login_request = login_request_schema.loads(response.content)
+            self.login_requests.set(challenge, login_request)
+            return login_request
         else:
             raise HydraException(f'{response.status_code} from server: {response.content.decode()}')
 
@@ -199,7 +459,9 @@ class Hydra:
         params = {'login_challenge': challenge}
         data = login_accept_schema.dumps(request)
 
-        response = put(url, data=data, headers=headers, params=params, verify=False)
+        self.login_requests.discard(challenge)
+
+        response = self.transport.request('accept_login', 'PUT', url, data=data, headers=headers, params=params)
 
         if response.status_code == 200:
             return redirect_schema.loads(response.content)
@@ -213,7 +475,9 @@ class Hydra:
         params = {'login_challenge': challenge}
         data = reject_schema.dumps(rejection)
 
-        response = put(url, data=data, headers=headers, params=params, verify=False)
+        self.login_requests.discard(challenge)
+
+        response = self.transport.request('reject_login', 'PUT', url, data=data, headers=headers, params=params)
 
         if response.status_code == 200:
             return redirect_schema.loads(response.content)
@@ -225,7 +489,7 @@ class Hydra:
         headers = {'Accept': 'application/json'}
         params = {'logout_challenge': challenge}
 
-        response = put(url, headers=headers, params=params, verify=False)
+        response = self.transport.request('accept_logout', 'PUT', url, headers=headers, params=params)
 
         if response.status_code == 200:
             return redirect_schema.loads(response.content)
@@ -237,7 +501,7 @@ class Hydra:
         headers = {'Content-Type': 'application/json'}
         params = {'subject': subject}
 
-        response = get(url, headers=headers, params=params, verify=False)
+        response = self.transport.request('get_consents', 'GET', url, headers=headers, params=params)
 
         if response.status_code == 200:
             print(f'\n\n{response.content}\n\n')
@@ -246,13 +510,19 @@ class Hydra:
             raise HydraException(f'{response.status_code} from server: {response.content.decode()}')
 
     def get_consent_request(self, challenge: str) -> ConsentRequest:
+        consent_request = self.consent_requests.get(challenge)
+        if consent_request is not None:
+            return consent_request
+
         query = urlencode({'consent_challenge': challenge})
         url = f'{self.url}/oauth2/auth/requests/consent?{query}'
 
-        response = get(url, verify=False)
+        response = self.transport.request('get_consent_request', 'GET', url)
 
         if response.status_code == 200:
-            return consent_request_schema.loads(response.content)
+            consent_request = consent_request_schema.loads(response.content)
+            self.consent_requests.set(challenge, consent_request)
+            return consent_request
         else:
             raise HydraException(f'{response.status_code} from server: {response.content.decode()}')
 
@@ -262,7 +532,9 @@ class Hydra:
         params = {'consent_challenge': challenge}
         data = grant_consent_schema.dumps(request)
 
-        response = put(url, data=data, headers=headers, params=params, verify=False)
+        self.consent_requests.discard(challenge)
+
+        response = self.transport.request('accept_consent', 'PUT', url, data=data, headers=headers, params=params)
 
         if response.status_code == 200:
             return redirect_schema.loads(response.content)
@@ -275,7 +547,9 @@ class Hydra:
         params = {'consent_challenge': challenge}
         data = reject_schema.dumps(rejection)
 
-        response = put(url, data=data, headers=headers, params=params, verify=False)
+        self.consent_requests.discard(challenge)
+
+        response = self.transport.request('reject_consent', 'PUT', url, data=data, headers=headers, params=params)
 
         if response.status_code == 200:
             return redirect_schema.loads(response.content)
@@ -287,7 +561,7 @@ class Hydra:
         headers = {'Content-Type': 'application/json'}
         params = {'subject': subject, 'client': client_id}
 
-        response = delete(url, headers=headers, params=params, verify=False)
+        response = self.transport.request('revoke_consent', 'DELETE', url, headers=headers, params=params)
 
         if response.status_code != 204:
             raise HydraException(f'{response.status_code} from server: {response.content.decode()}')
@@ -309,33 +583,91 @@ class Hydra:
             'response_types': ['token', 'code', 'id_token'],
         })
 
-        response = post(url, data=data, headers=headers, verify=False)
+        response = self.transport.request('create_oauth2_client', 'POST', url, data=data, headers=headers)
 
         if response.status_code != 201:
             raise HydraException(f'{response.status_code} from server: {response.content.decode()}')
 
-    def get_oauth2_clients(self):
-        query = urlencode({
-            'offset': 0,
-            'limit': 99999,
-        })
+        self.clients.add(json.loads(response.content))
 
-        url = f'{self.url}/clients?{query}'
+    def iter_oauth2_clients(self):
+        """
+        Iterates all clients in Hydra one page at a time.
+        """
+        offset = 0
 
-        response = get(url, verify=False)
+        while True:
+            query = urlencode({
+                'offset': offset,
+                'limit': self.client_page_size,
+            })
 
-        if response.status_code == 200:
-            return json.loads(response.content)
-        else:
+            url = f'{self.url}/clients?{query}'
+
+            response = self.transport.request('get_oauth2_clients', 'GET', url)
+
+            if response.status_code != 200:
+                raise HydraException(f'{response.status_code} from server: {response.content.decode()}')
+
+            page = json.loads(response.content)
+
+            yield from page
+
+            if len(page) < self.client_page_size:
+                break
+
+            offset += len(page)
+
+    def get_oauth2_clients(self):
+        return list(self.iter_oauth2_clients())
+
+    def get_oauth2_clients_by_owner(self, owner):
+        """
+        :param str owner:
+        :rtype: list[dict]
+        """
+        return self.clients.get(owner)
+
+    def get_oauth2_client(self, client_id):
+        """
+        Returns a single client directly from Hydra, or None if it
+        does not exist.
+
+        :param str client_id:
+        :rtype: dict
+        """
+        url = f'{self.url}/clients/{quote(client_id, safe="")}'
+
+        response = self.transport.request('get_oauth2_client', 'GET', url)
+
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
             raise HydraException(f'{response.status_code} from server: {response.content.decode()}')
 
+        return json.loads(response.content)
+
     def delete_oauth2_client(self, client_id):
-        url = f'{self.url}/clients/{client_id}'
+        url = f'{self.url}/clients/{quote(client_id, safe="")}'
 
-        response = delete(url, verify=False)
+        response = self.transport.request('delete_oauth2_client', 'DELETE', url)
 
         if response.status_code not in (200, 204):
             raise HydraException(f'{response.status_code} from server: {response.content.decode()}')
 
-
-hydra = Hydra(HYDRA_URL)
+        self.clients.remove(client_id)
+
+
+hydra = Hydra(
+    url=HYDRA_URL,
+    transport=HydraTransport(
+        pool_size=HYDRA_POOL_SIZE,
+        connect_timeout=HYDRA_CONNECT_TIMEOUT,
+        read_timeout=HYDRA_READ_TIMEOUT,
+        keep_alive=HYDRA_KEEP_ALIVE,
+    ),
+    request_cache_size=HYDRA_REQUEST_CACHE_SIZE,
+    request_cache_ttl=HYDRA_REQUEST_CACHE_TTL,
+    client_page_size=HYDRA_CLIENT_PAGE_SIZE,
+    client_index_refresh=HYDRA_CLIENT_INDEX_REFRESH,
+)
@@ -0,0 +1,326 @@
+import re
+import math
+import time
+import bisect
+import threading
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .concurrency import native_lock
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+# Upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+FAST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+
+
+class Metric(object, metaclass=ABCMeta):
+    """
+    Base class for metrics. Values are kept per combination of label
+    values, and guarded by a native lock, so they can be updated from
+    greenlets and native threads alike.
+    """
+
+    TYPE = None
+
+    def __init__(self, name, help, labels=()):
+        """
+        :param str name:
+        :param str help:
+        :param tuple[str] labels: Names of the labels
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = native_lock()
+        self._values = {}
+
+    def _key(self, labels):
+        """
+        :param dict labels:
+        :rtype: tuple[str]
+        """
+        return tuple(str(labels[name]) for name in self.labels)
+
+    @abstractmethod
+    def samples(self):
+        """
+        :return: Tuples of (name, labels, value)
+        :rtype: collections.abc.Iterable[(str, dict, float)]
+        """
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """
+        :param float amount:
+        :param labels: Value of each label
+        """
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+
+        for key, value in values:
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        :param str name:
+        :param str help:
+        :param tuple[str] labels: Names of the labels
+        :param tuple[float] buckets: Upper bounds of the buckets
+        """
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """
+        :param float value:
+        :param labels: Value of each label
+        """
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, one for +Inf, and the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """
+        Returns a context manager which observes the time spent
+        within it, in seconds.
+
+        :param labels: Value of each label
+        :rtype: Timer
+        """
+        return Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+
+        for key, counts in values:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', dict(labels, le=_format_value(bound)), cumulative
+
+            yield f'{self.name}_sum', labels, counts[-1]
+            yield f'{self.name}_count', labels, cumulative
+
+
+class Timer(object):
+    """
+    Context manager which observes the time spent within it.
+    """
+
+    def __init__(self, histogram, labels):
+        """
+        :param Histogram histogram:
+        :param dict labels:
+        """
+        self.histogram = histogram
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class MetricsRegistry(object):
+    """
+    In-process registry of metrics, rendered in the Prometheus text
+    exposition format.
+
+    Besides counters and histograms, the statistics which components
+    already keep (their stats() dicts) are exposed as gauges, read when
+    the metrics are rendered.
+    """
+
+    def __init__(self, prefix):
+        """
+        :param str prefix: Prefix of all metric names
+        """
+        self.prefix = prefix
+        self.metrics = []
+        self.stats = []
+
+    def counter(self, name, help, labels=()):
+        """
+        :param str name: Name without prefix, ie. "hydra_requests_total"
+        :param str help:
+        :param tuple[str] labels:
+        :rtype: Counter
+        """
+        return self._add(Counter(f'{self.prefix}_{name}', help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        :param str name: Name without prefix, ie. "request_duration_seconds"
+        :param str help:
+        :param tuple[str] labels:
+        :param tuple[float] buckets:
+        :rtype: Histogram
+        """
+        return self._add(Histogram(f'{self.prefix}_{name}', help, labels, buckets))
+
+    def register_stats(self, name, func, label=None):
+        """
+        Exposes the numbers in the dict returned by func() as gauges
+        named "<prefix>_<name>_<key>". Nested dicts of dicts, ie. stats
+        per route, are labelled with "name".
+
+        :param str name:
+        :param typing.Callable[[], dict] func:
+        :param str label: Label the top-level keys with this label, for
+            functions returning a dict of dicts (ie. stats per flow)
+        """
+        self.stats.append((f'{self.prefix}_{name}', func, label))
+
+    def render(self):
+        """
+        :rtype: str
+        """
+        lines = []
+
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            lines.extend(_format_sample(*sample) for sample in metric.samples())
+
+        gauges = OrderedDict()
+
+        for prefix, func, label in self.stats:
+            stats = func()
+
+            if label is None:
+                samples = _flatten(prefix, stats, {})
+            else:
+                samples = (
+                    sample
+                    for key, inner in stats.items()
+                    for sample in _flatten(prefix, inner, {label: key})
+                )
+
+            for name, labels, value in samples:
+                gauges.setdefault(name, []).append((name, labels, value))
+
+        for name, samples in gauges.items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.extend(_format_sample(*sample) for sample in samples)
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port):
+        """
+        Serves the metrics at /metrics on the given port from a
+        background thread, for processes which don't run the app
+        (ie. the e-mail dispatcher).
+
+        :param int port:
+        :rtype: ThreadingHTTPServer
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(('', port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+def _flatten(prefix, stats, labels):
+    """
+    :param str prefix:
+    :param dict stats:
+    :param dict labels:
+    :rtype: collections.abc.Iterable[(str, dict, float)]
+    """
+    for key, value in stats.items():
+        name = re.sub(r'[^a-zA-Z0-9_]', '_', f'{prefix}_{key}')
+
+        if isinstance(value, (bool, int, float)):
+            yield name, labels, value
+        elif isinstance(value, dict):
+            if value and all(isinstance(v, dict) for v in value.values()):
+                for sub_key, sub_value in value.items():
+                    yield from _flatten(name, sub_value, dict(labels, name=sub_key))
+            else:
+                yield from _flatten(name, value, labels)
+
+
+def _format_sample(name, labels, value):
+    """
+    :param str name:
+    :param dict labels:
+    :param float value:
+    :rtype: str
+    """
+    if labels:
+        pairs = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+        return f'{name}{{{pairs}}} {_format_value(value)}'
+    return f'{name} {_format_value(value)}'
+
+
+def _format_value(value):
+    """
+    :param float value:
+    :rtype: str
+    """
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+def _escape(value):
+    """
+    :param str value:
+    :rtype: str
+    """
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+metrics = MetricsRegistry('identity')
@@ -1,5 +1,6 @@
 import sqlalchemy as sa
 from sqlalchemy.orm import relationship
+from sqlalchemy.dialects.postgresql import JSONB
 
 from .db import ModelBase
 
@@ -11,30 +12,24 @@ class User(ModelBase):
     __tablename__ = 'user'
     __table_args__ = (
         sa.UniqueConstraint('subject'),
-        sa.UniqueConstraint('email'),
     )
 
-    id = sa.Column(sa.Integer, primary_key=True, index=True)
+    id = sa.Column(sa.Integer, primary_key=True)
     created = sa.Column(sa.DateTime(timezone=True), server_default=sa.func.now())
+    updated = sa.Column(sa.DateTime(timezone=True), server_default=sa.func.now(), onupdate=sa.func.now(), index=True, nullable=False)
     active = sa.Column(sa.Boolean(), default=False, nullable=False)
     disabled = sa.Column(sa.Boolean(), default=False, nullable=False)
 
     # Hydra Subject ID
-    subject = sa.Column(sa.String(), index=True, nullable=False)
+    subject = sa.Column(sa.String(), nullable=False)
 
-    # Details
-    email = sa.Column(sa.String(), index=True, nullable=False)
-    phone = sa.Column(sa.String(), index=True)
+    # Details (e-mail is unique case-insensitively, see ix_user_email_lower)
+    email = sa.Column(sa.String(), nullable=False)
+    phone = sa.Column(sa.String())
     password = sa.Column(sa.String(), nullable=False)
     name = sa.Column(sa.String(), nullable=False)
     company = sa.Column(sa.String(), nullable=False)
 
-    # Token for activating / verifying e-mail
-    activate_token = sa.Column(sa.String())
-
-    # Token for resetting password
-    reset_password_token = sa.Column(sa.String())
-
     def __str__(self):
         return 'User<%s>' % self.sub
 
@@ -48,6 +43,108 @@ class User(ModelBase):
         }
 
 
+class UserToken(ModelBase):
+    """
+    Represents one single-use token issued to a user, ie. for activating
+    the account or resetting the password. Only a hash of the token is
+    stored, and the token is invalid after it expires.
+    """
+    __tablename__ = 'user_token'
+    __table_args__ = (
+        sa.UniqueConstraint('token_hash'),
+    )
+
+    # Token types
+    ACTIVATE = 'activate'
+    RESET_PASSWORD = 'reset_password'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    created = sa.Column(sa.DateTime(timezone=True), server_default=sa.func.now())
+    expires = sa.Column(sa.DateTime(timezone=True), index=True, nullable=False)
+
+    user_id = sa.Column(sa.Integer(), sa.ForeignKey('user.id', ondelete='CASCADE'), index=True, nullable=False)
+    user = relationship('User', foreign_keys=[user_id])
+
+    type = sa.Column(sa.String(), nullable=False)
+    token_hash = sa.Column(sa.String(), nullable=False)
+
+    def __str__(self):
+        return 'UserToken<%s>' % self.id
+
+
+class OutboxEmail(ModelBase):
+    """
+    Represents one e-mail waiting to be sent by the e-mail dispatcher.
+    Written in the same transaction as the change which triggers it.
+
+    Sent and failed e-mails are kept, without their body, until they
+    are deleted by purge_sent_emails.py.
+    """
+    __tablename__ = 'email_outbox'
+    __table_args__ = (
+        sa.Index(
+            'ix_email_outbox_pending',
+            'next_attempt',
+            postgresql_where=sa.text('sent IS NULL AND failed IS NULL'),
+        ),
+        sa.Index(
+            'ix_email_outbox_done',
+            'created',
+            postgresql_where=sa.text('sent IS NOT NULL OR failed IS NOT NULL'),
+        ),
+    )
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    created = sa.Column(sa.DateTime(timezone=True), server_default=sa.func.now())
+
+    # Message
+    recipient = sa.Column(sa.String(), nullable=False)
+    subject = sa.Column(sa.String(), nullable=False)
+    # Cleared once sent or failed, as it may contain a token
+    body = sa.Column(sa.Text())
+
+    # Delivery
+    attempts = sa.Column(sa.Integer(), default=0, nullable=False)
+    next_attempt = sa.Column(sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False)
+    last_error = sa.Column(sa.String())
+    sent = sa.Column(sa.DateTime(timezone=True))
+    failed = sa.Column(sa.DateTime(timezone=True))
+
+    def __str__(self):
+        return 'OutboxEmail<%s>' % self.id
+
+
+class AuditEvent(ModelBase):
+    """
+    Represents one authentication event, ie. a login or a password
+    change. Written in batches by the audit log, never updated.
+
+    The table is partitioned by month on "created", and partitions are
+    created ahead of time by maintain_audit_partitions.py. There is no
+    default partition, so events outside the existing partitions can
+    not be written.
+    """
+    __tablename__ = 'audit_event'
+    __table_args__ = (
+        sa.PrimaryKeyConstraint('id', 'created'),
+        {'postgresql_partition_by': 'RANGE (created)'},
+    )
+
+    id = sa.Column(sa.BigInteger(), autoincrement=True)
+    created = sa.Column(sa.DateTime(timezone=True), nullable=False)
+    event = sa.Column(sa.String(), nullable=False)
+    subject = sa.Column(sa.String())
+    email = sa.Column(sa.String())
+    ip = sa.Column(sa.String())
+    details = sa.Column(JSONB(none_as_null=True))
+
+    def __str__(self):
+        return 'AuditEvent<%s>' % self.id
+
+
+sa.Index('ix_user_email_lower', sa.func.lower(User.email), unique=True)
+
+
 # class OauthClient(ModelBase):
 #     """
 #     Represents one 3rd party client.
@@ -76,4 +173,7 @@ class User(ModelBase):
 
 VERSIONED_DB_MODELS = (
     User,
+    UserToken,
+    OutboxEmail,
+    AuditEvent,
 )
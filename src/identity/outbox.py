@@ -0,0 +1,172 @@
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import or_
+
+from .db import atomic
+from .email import email_transport
+from .metrics import metrics
+from .models import OutboxEmail
+from .settings import (
+    PROJECT_NAME,
+    EMAIL_DISPATCH_BATCH_SIZE,
+    EMAIL_DISPATCH_INTERVAL,
+    EMAIL_DISPATCH_MAX_ATTEMPTS,
+    EMAIL_DISPATCH_BACKOFF,
+    EMAIL_DISPATCH_MAX_BACKOFF,
+)
+
+
+logger = logging.getLogger(f'{PROJECT_NAME}.outbox')
+
+
+EMAIL_SEND_SECONDS = metrics.histogram(
+    'email_send_duration_seconds',
+    'Time spent sending an e-mail, per transport',
+    labels=('transport',),
+)
+
+EMAIL_SENDS = metrics.counter(
+    'email_sends_total',
+    'E-mails sent per transport and result ("sent" or "error")',
+    labels=('transport', 'result'),
+)
+
+
+class EmailDispatcher(object):
+    """
+    Drains the e-mail outbox in batches.
+
+    Each batch is locked with SKIP LOCKED, so multiple dispatchers can
+    run side by side without sending the same e-mail twice. Failed
+    e-mails are retried with exponential backoff until they run out
+    of attempts.
+    """
+
+    def __init__(self, transport, batch_size, interval, max_attempts,
+                 backoff, max_backoff):
+        """
+        :param EmailTransport transport:
+        :param int batch_size: Max. number of e-mails per batch
+        :param float interval: Seconds to sleep when the outbox is empty
+        :param int max_attempts: Number of attempts before giving up
+        :param float backoff: Seconds to wait after the first failure
+        :param float max_backoff: Max. seconds to wait between attempts
+        """
+        self.transport = transport
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def run_forever(self):
+        while True:
+            try:
+                count = self.dispatch_batch()
+            except Exception:
+                logger.exception('Failed to dispatch e-mails')
+                count = 0
+            else:
+                if count:
+                    logger.info(f'Dispatched {count} e-mails')
+
+            if count < self.batch_size:
+                time.sleep(self.interval)
+
+    @atomic
+    def dispatch_batch(self, session):
+        """
+        Sends one batch of due e-mails.
+
+        :param Session session:
+        :return: Number of e-mails in the batch
+        :rtype: int
+        """
+        now = datetime.now(tz=timezone.utc)
+
+        emails = session.query(OutboxEmail) \
+            .filter(OutboxEmail.sent.is_(None)) \
+            .filter(OutboxEmail.failed.is_(None)) \
+            .filter(OutboxEmail.next_attempt <= now) \
+            .order_by(OutboxEmail.next_attempt) \
+            .limit(self.batch_size) \
+            .with_for_update(skip_locked=True) \
+            .all()
+
+        for email in emails:
+            try:
+                self.send(email)
+            except Exception as e:
+                logger.exception(f'Failed to send {email}')
+                self.retry_later(email, str(e), now)
+            else:
+                email.sent = now
+                email.body = None
+
+        return len(emails)
+
+    def send(self, email):
+        """
+        Sends an e-mail with the transport, and measures the send.
+
+        :param OutboxEmail email:
+        """
+        result = 'error'
+
+        try:
+            with EMAIL_SEND_SECONDS.time(transport=self.transport.name):
+                self.transport.send(email)
+            result = 'sent'
+        finally:
+            EMAIL_SENDS.inc(transport=self.transport.name, result=result)
+
+    def retry_later(self, email, error, now):
+        """
+        :param OutboxEmail email:
+        :param str error:
+        :param datetime now:
+        """
+        email.attempts += 1
+        email.last_error = error
+
+        if email.attempts >= self.max_attempts:
+            email.failed = now
+            email.body = None
+        else:
+            backoff = self.backoff * 2 ** (email.attempts - 1)
+            email.next_attempt = now + timedelta(seconds=min(backoff, self.max_backoff))
+
+    @atomic
+    def purge_sent(self, retention_days, batch_size, session):
+        """
+        Deletes one batch of sent and failed e-mails created more than
+        retention_days ago. E-mails still waiting to be sent are kept.
+
+        :param float retention_days:
+        :param int batch_size:
+        :param Session session:
+        :return: Number of e-mails deleted
+        :rtype: int
+        """
+        cutoff = datetime.now(tz=timezone.utc) - timedelta(days=retention_days)
+
+        done = session.query(OutboxEmail.id) \
+            .filter(or_(OutboxEmail.sent.isnot(None), OutboxEmail.failed.isnot(None))) \
+            .filter(OutboxEmail.created < cutoff) \
+            .limit(batch_size) \
+            .with_for_update(skip_locked=True)
+
+        return session.query(OutboxEmail) \
+            .filter(OutboxEmail.id.in_(done.subquery())) \
+            .delete(synchronize_session=False)
+
+
+dispatcher = EmailDispatcher(
+    transport=email_transport,
+    batch_size=EMAIL_DISPATCH_BATCH_SIZE,
+    interval=EMAIL_DISPATCH_INTERVAL,
+    max_attempts=EMAIL_DISPATCH_MAX_ATTEMPTS,
+    backoff=EMAIL_DISPATCH_BACKOFF,
+    max_backoff=EMAIL_DISPATCH_MAX_BACKOFF,
+)
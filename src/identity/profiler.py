@@ -0,0 +1,247 @@
+import os
+import sys
+import time
+import logging
+from collections import Counter
+from datetime import datetime
+
+import jwt
+import greenlet
+
+from .concurrency import is_gevent_patched, native_lock
+from .settings import (
+    PROJECT_NAME,
+    SECRET,
+    PROFILER_ENABLED,
+    PROFILER_OUTPUT_DIR,
+    PROFILER_INTERVAL_MS,
+    PROFILER_MIN_INTERVAL,
+    PROFILER_MAX_SECONDS,
+)
+
+
+logger = logging.getLogger(f'{PROJECT_NAME}.profiler')
+
+
+# Audience of profiling tokens, so other tokens signed with the same
+# secret can not be used to profile requests, and vice versa
+TOKEN_AUDIENCE = 'profile'
+
+
+def _native(module, name):
+    """
+    Returns the original (unpatched) function when running under gevent.
+
+    :param str module:
+    :param str name:
+    """
+    if is_gevent_patched():
+        from gevent.monkey import get_original
+        return get_original(module, name)
+    return getattr(__import__(module), name)
+
+
+class Profile(object):
+    """
+    Samples the stack of one greenlet (ie. the one handling a request)
+    at a fixed interval, from a native thread.
+
+    Switches between greenlets are traced, so each sample is taken from
+    where the greenlet actually is: its running frame when it is on the
+    CPU, or the frame it is suspended in when it is waiting (ie. for
+    Hydra, the database or the hashing pool). Samples are marked as
+    [on-cpu] or [off-cpu] accordingly.
+    """
+
+    def __init__(self, interval, max_seconds):
+        """
+        :param float interval: Seconds between samples
+        :param float max_seconds: Stop sampling after this long
+        """
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.target = greenlet.getcurrent()
+        self.thread_id = _native('_thread', 'get_ident')()
+        self.running = self.target
+        self.samples = Counter()
+        self.stopped = False
+        self.started = None
+        self.elapsed = None
+        self._previous_trace = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._previous_trace = greenlet.settrace(self._trace)
+        _native('_thread', 'start_new_thread')(self._sample_forever, ())
+
+    def stop(self):
+        self.stopped = True
+        self.elapsed = time.perf_counter() - self.started
+        greenlet.settrace(self._previous_trace)
+
+    def collapsed(self):
+        """
+        Returns the samples as collapsed stacks, one line per stack,
+        ie. for flamegraph.pl or speedscope.
+
+        :rtype: str
+        """
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+    def _trace(self, event, args):
+        if event in ('switch', 'throw'):
+            origin, target = args
+            self.running = target
+        if self._previous_trace is not None:
+            self._previous_trace(event, args)
+
+    def _sample_forever(self):
+        sleep = _native('time', 'sleep')
+        deadline = time.perf_counter() + self.max_seconds
+
+        while not self.stopped and time.perf_counter() < deadline:
+            sleep(self.interval)
+            self._sample()
+
+    def _sample(self):
+        if self.running is self.target:
+            state = '[on-cpu]'
+            frame = sys._current_frames().get(self.thread_id)
+        else:
+            state = '[off-cpu]'
+            frame = self.target.gr_frame
+
+        if frame is None:
+            return
+
+        stack = []
+
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+
+        stack.append(state)
+        self.samples[';'.join(reversed(stack))] += 1
+
+
+class Profiler(object):
+    """
+    Profiles single requests on demand.
+
+    A request is profiled if it carries a token, signed with the
+    application secret, in the X-Profile header (see profile_token.py).
+    At most one request is profiled at a time, and at most once per
+    min_interval seconds, so a leaked token can not be used to slow
+    the service down.
+
+    Profiles are written as collapsed stacks to the output directory.
+    """
+
+    HEADER = 'X-Profile'
+
+    def __init__(self, enabled, output_dir, interval_ms, min_interval, max_seconds):
+        """
+        :param bool enabled:
+        :param str output_dir:
+        :param float interval_ms: Milliseconds between samples
+        :param float min_interval: Min. seconds between two profiles
+        :param float max_seconds: Max. seconds to sample a request
+        """
+        self.enabled = enabled
+        self.output_dir = output_dir
+        self.interval = interval_ms / 1000
+        self.min_interval = min_interval
+        self.max_seconds = max_seconds
+        self.active = False
+        self.last_started = None
+        self._lock = native_lock()
+
+        # Metrics
+        self.profiles = 0
+        self.rate_limited = 0
+        self.invalid_tokens = 0
+
+    def start(self, token):
+        """
+        Starts profiling the current greenlet if the token is valid
+        and the rate limit allows it.
+
+        :param str token:
+        :rtype: Profile
+        """
+        if not self.enabled or not token:
+            return None
+
+        try:
+            jwt.decode(token, SECRET, algorithms=['HS256'],
+                       audience=TOKEN_AUDIENCE, options={'require_exp': True})
+        except jwt.InvalidTokenError:
+            self.invalid_tokens += 1
+            return None
+
+        now = time.monotonic()
+
+        with self._lock:
+            if self.active or (self.last_started is not None
+                               and now - self.last_started < self.min_interval):
+                self.rate_limited += 1
+                return None
+            self.active = True
+            self.last_started = now
+
+        profile = Profile(self.interval, self.max_seconds)
+        profile.start()
+        return profile
+
+    def finish(self, profile, name):
+        """
+        Stops the profile and writes it to the output directory.
+
+        :param Profile profile:
+        :param str name: Name of what was profiled, ie. the endpoint
+        :return: The file name of the profile
+        :rtype: str
+        """
+        try:
+            profile.stop()
+        finally:
+            self.active = False
+
+        self.profiles += 1
+        filename = f'{datetime.utcnow():%Y%m%dT%H%M%S}-{name}-{os.getpid()}.collapsed'
+
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(os.path.join(self.output_dir, filename), 'w') as f:
+                f.write(profile.collapsed())
+        except OSError:
+            logger.exception(f'Failed to write profile {filename}')
+            return None
+
+        logger.info(
+            f'Profiled {name} for {profile.elapsed * 1000:.1f} ms, '
+            f'{sum(profile.samples.values())} samples written to {filename}'
+        )
+
+        return filename
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'active': self.active,
+            'profiles': self.profiles,
+            'rate_limited': self.rate_limited,
+            'invalid_tokens': self.invalid_tokens,
+        }
+
+
+profiler = Profiler(
+    enabled=PROFILER_ENABLED,
+    output_dir=PROFILER_OUTPUT_DIR,
+    interval_ms=PROFILER_INTERVAL_MS,
+    min_interval=PROFILER_MIN_INTERVAL,
+    max_seconds=PROFILER_MAX_SECONDS,
+)
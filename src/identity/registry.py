@@ -1,21 +1,65 @@
 import hashlib
 from uuid import uuid4
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import bindparam, func
+from sqlalchemy.ext import baked
 
-from .db import atomic, inject_session
-from .models import User
-from .settings import SECRET
+from .db import atomic, inject_session, current_unit_of_work, after_unit_of_work
+from .cache import TTLCache
+from .email import email_service
+from .hashing import password_hasher
+from .models import User, UserToken
+from .settings import (
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+    ACTIVATE_TOKEN_EXPIRE_SECONDS,
+    RESET_PASSWORD_TOKEN_EXPIRE_SECONDS,
+)
+
+
+# Cache of compiled queries, so the hot lookups are only built and
+# compiled to SQL once per shape instead of on every call
+bakery = baked.bakery()
+
+
+def invalidates_user(func):
+    """
+    Function decorator for UserRegistry methods which change a user.
+    Drops the user from the cache after the change has been committed.
+    """
+    def invalidates_user_wrapper(self, user, *args, **kwargs):
+        try:
+            return func(self, user, *args, **kwargs)
+        finally:
+            after_unit_of_work(self.invalidate, user)
+
+    return invalidates_user_wrapper
 
 
 class UserRegistry(object):
 
+    # Lookups which can be served from the cache
+    CACHED_LOOKUPS = ('subject', 'email')
+
+    def __init__(self, cache_size, cache_ttl):
+        """
+        :param int cache_size:
+        :param float cache_ttl:
+        """
+        self.cache = TTLCache(cache_size, cache_ttl)
+
     @atomic
-    def create(self, name, company, email, phone, password, session):
+    def create(self, name, company, email, phone, password, challenge, session):
         """
+        Creates a new (inactive) user and queues a welcome e-mail
+        with a link for activating it.
+
         :param str name:
         :param str company:
         :param str email:
         :param str phone:
         :param str password:
+        :param str challenge:
         :param Session session:
         :rtype: User
         """
@@ -27,28 +71,32 @@ class UserRegistry(object):
             name=name,
             company=company,
             active=False,
-            activate_token=str(uuid4()),
         )
 
         session.add(user)
 
+        token = self._issue_token(
+            user, UserToken.ACTIVATE, ACTIVATE_TOKEN_EXPIRE_SECONDS, session)
+
+        email_service.queue_welcome_email(user, token, challenge, session)
+
         return user
 
+    @invalidates_user
     @atomic
     def activate(self, user, session):
         """
+        Activates the user and consumes its activation token.
+
         :param User user:
         :param Session session:
         :rtype: User
         """
         user.active = True
-        user.activate_token = None
         session.query(User) \
             .filter(User.id == user.id) \
-            .update({
-                'active': True,
-                'activate_token': None,
-            })
+            .update({'active': True})
+        self._delete_tokens(user, UserToken.ACTIVATE, session)
 
     @inject_session
     def authenticate(self, email, password, session):
@@ -58,30 +106,260 @@ class UserRegistry(object):
         :param Session session:
         :rtype: User
         """
-        filters = (
-            User.email == self.normalize_email(email),
-            User.password == self.password_hash(password),
+        user = self._query_credentials(email, session=session)
+
+        # End the transaction and return the connection to the pool
+        # before hashing, so a login doesn't hold a connection for the
+        # duration of the hash. Closing detaches the user without
+        # expiring its attributes.
+        if not session.info.get('unit_of_work'):
+            session.close()
+
+        if user is None:
+            # Hash anyway, so unknown, inactive and disabled e-mails
+            # take as long to reject as a wrong password
+            password_hasher.verify_dummy(password)
+            return None
+
+        if not self.check_password(user, password):
+            return None
+
+        if password_hasher.needs_rehash(user.password):
+            self.rehash_password(user, password)
+
+        return user
+
+    def _query_credentials(self, email, session):
+        """
+        Looks up an active (and not disabled) user by e-mail.
+
+        :param str email:
+        :param Session session:
+        :rtype: User
+        """
+        query = bakery(lambda session: session.query(User))
+        query += lambda q: q.filter(
+            func.lower(User.email) == bindparam('email'),
             User.active.is_(True),
             User.disabled.is_(False),
         )
 
-        return session.query(User) \
-            .filter(*filters) \
+        return query(session) \
+            .params(email=self.normalize_email(email)) \
             .one_or_none()
 
-    @inject_session
-    def get_user(self, session, **filters):
+    def get_user(self, **filters):
         """
-        :param Session session:
+        Lookups by only subject or only e-mail are served from the
+        cache when possible.
+
+        Within a unit of work the cache is bypassed, and users already
+        loaded in the unit's session are not queried again.
+
         :rtype: User
         """
         if 'email' in filters:
             filters['email'] = self.normalize_email(filters['email'])
 
-        return session.query(User) \
-            .filter_by(**filters) \
+        session = current_unit_of_work()
+
+        if session is not None:
+            for obj in session.identity_map.values():
+                if isinstance(obj, User) and all(getattr(obj, k) == v for k, v in filters.items()):
+                    return obj
+            return self._query_user(session=session, **filters)
+
+        if len(filters) != 1 or next(iter(filters)) not in self.CACHED_LOOKUPS:
+            return self._query_user(**filters)
+
+        key = next(iter(filters.items()))
+        user = self.cache.get(key)
+
+        if user is None:
+            user = self._query_user(**filters)
+            if user is not None:
+                self.cache.set(('subject', user.subject), user)
+                self.cache.set(('email', user.email), user)
+
+        return user
+
+    @inject_session
+    def _query_user(self, session, **filters):
+        """
+        Looks up a user by the given column values. The query is cached
+        per set of columns, ie. by subject or by e-mail.
+
+        :param Session session:
+        :rtype: User
+        """
+        columns = tuple(sorted(filters))
+
+        query = bakery(lambda session: session.query(User))
+        query.add_criteria(lambda q: q.filter(
+            *(self._column(c) == bindparam(c) for c in columns)), columns)
+
+        return query(session) \
+            .params(**filters) \
+            .one_or_none()
+
+    def _column(self, name):
+        """
+        Returns the expression to filter on for the given column.
+        E-mails are compared in lower case to use ix_user_email_lower.
+
+        :param str name:
+        """
+        if name == 'email':
+            return func.lower(User.email)
+        return getattr(User, name)
+
+    @inject_session
+    def get_user_by_token(self, email, type, token, session):
+        """
+        Looks up a user by e-mail and a valid (unexpired) token.
+
+        :param str email:
+        :param str type: One of UserToken.ACTIVATE or UserToken.RESET_PASSWORD
+        :param str token:
+        :param Session session:
+        :rtype: User
+        """
+        query = bakery(lambda session: session.query(User))
+        query += lambda q: q \
+            .join(UserToken, UserToken.user_id == User.id) \
+            .filter(
+                func.lower(User.email) == bindparam('email'),
+                UserToken.type == bindparam('type'),
+                UserToken.token_hash == bindparam('token_hash'),
+                UserToken.expires > func.now(),
+            )
+
+        return query(session) \
+            .params(
+                email=self.normalize_email(email),
+                type=type,
+                token_hash=self._hash_token(token),
+            ) \
             .one_or_none()
 
+    @inject_session
+    def has_token(self, user, type, session):
+        """
+        Returns whether the user has a valid (unexpired) token
+        of the given type.
+
+        :param User user:
+        :param str type: One of UserToken.ACTIVATE or UserToken.RESET_PASSWORD
+        :param Session session:
+        :rtype: bool
+        """
+        query = bakery(lambda session: session.query(UserToken.id))
+        query += lambda q: q.filter(
+            UserToken.user_id == bindparam('user_id'),
+            UserToken.type == bindparam('type'),
+            UserToken.expires > func.now(),
+        )
+
+        return query(session) \
+            .params(user_id=user.id, type=type) \
+            .first() is not None
+
+    def check_token(self, user, type, token):
+        """
+        Returns whether the token is a valid (unexpired) token
+        of the given type issued to the user.
+
+        :param User user:
+        :param str type: One of UserToken.ACTIVATE or UserToken.RESET_PASSWORD
+        :param str token:
+        :rtype: bool
+        """
+        owner = self.get_user_by_token(user.email, type, token)
+        return owner is not None and owner.id == user.id
+
+    def _issue_token(self, user, type, expire_seconds, session):
+        """
+        Issues a new token of the given type to the user, replacing any
+        previous token of the same type. Only a hash of the token is
+        stored, so it is returned here for sending to the user.
+
+        :param User user:
+        :param str type: One of UserToken.ACTIVATE or UserToken.RESET_PASSWORD
+        :param int expire_seconds:
+        :param Session session:
+        :rtype: str
+        """
+        token = str(uuid4())
+
+        user_token = UserToken(
+            type=type,
+            token_hash=self._hash_token(token),
+            expires=datetime.now(tz=timezone.utc) + timedelta(seconds=expire_seconds),
+        )
+
+        if user.id is None:
+            # A new user, which is flushed along with its token
+            user_token.user = user
+        else:
+            # Existing users may be the shared instances cached by
+            # get_user(), which must not be attached to this session
+            self._delete_tokens(user, type, session)
+            user_token.user_id = user.id
+
+        session.add(user_token)
+
+        return token
+
+    def _delete_tokens(self, user, type, session):
+        """
+        :param User user:
+        :param str type: One of UserToken.ACTIVATE or UserToken.RESET_PASSWORD
+        :param Session session:
+        """
+        session.query(UserToken) \
+            .filter(UserToken.user_id == user.id) \
+            .filter(UserToken.type == type) \
+            .delete(synchronize_session=False)
+
+    def _hash_token(self, token):
+        """
+        Tokens are random UUIDs, so a plain (unsalted) SHA-256 is enough
+        to keep them from being usable if the table is leaked, while
+        still allowing lookups by hash.
+
+        :param str token:
+        :rtype: str
+        """
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    @atomic
+    def purge_expired_tokens(self, batch_size, session):
+        """
+        Deletes one batch of expired tokens.
+
+        :param int batch_size:
+        :param Session session:
+        :return: Number of tokens deleted
+        :rtype: int
+        """
+        expired = session.query(UserToken.id) \
+            .filter(UserToken.expires <= func.now()) \
+            .limit(batch_size) \
+            .with_for_update(skip_locked=True)
+
+        return session.query(UserToken) \
+            .filter(UserToken.id.in_(expired.subquery())) \
+            .delete(synchronize_session=False)
+
+    def invalidate(self, user):
+        """
+        Drops the user from the cache.
+
+        :param User user:
+        """
+        self.cache.discard(('subject', user.subject))
+        self.cache.discard(('email', user.email))
+
     def email_available(self, email):
         """
         :param str email:
@@ -101,8 +379,17 @@ class UserRegistry(object):
         :param str password:
         :rtype: str
         """
-        return hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), SECRET.encode('utf-8'), 100000).hex()
+        return password_hasher.hash(password)
+
+    def check_password(self, user, password):
+        """
+        :param User user:
+        :param str password:
+        :rtype: bool
+        """
+        return password_hasher.verify(password, user.password)
 
+    @invalidates_user
     @atomic
     def update_details(self, user, session, **details):
         """
@@ -113,32 +400,61 @@ class UserRegistry(object):
             .filter(User.id == user.id) \
             .update(details)
 
+    @invalidates_user
     @atomic
     def assign_password(self, user, password, session):
         """
+        Assigns a new password and consumes the user's reset token.
+
         :param User user:
         :param str password:
         :param Session session:
         """
+        # Hashed before the first statement, so no transaction is open
+        # while hashing (unless within a unit of work which has already
+        # started one)
+        password = self.password_hash(password)
+
         session.query(User) \
             .filter(User.id == user.id) \
-            .update({
-                'password': self.password_hash(password),
-                'reset_password_token': None,
-            })
+            .update({'password': password})
+        self._delete_tokens(user, UserToken.RESET_PASSWORD, session)
 
+    @invalidates_user
     @atomic
-    def assign_reset_password_token(self, user, session):
+    def rehash_password(self, user, password, session):
         """
+        Re-hashes the user's password with the current hashing
+        parameters. Unlike assign_password(), the user's reset token
+        is left untouched.
+
         :param User user:
+        :param str password:
         :param Session session:
         """
-        token = str(uuid4())
-        user.reset_password_token = token
+        # Hashed before the first statement, so the transaction only
+        # spans the update
+        user.password = self.password_hash(password)
         session.query(User) \
             .filter(User.id == user.id) \
-            .update({'reset_password_token': token})
+            .update({'password': user.password})
+
+    @atomic
+    def assign_reset_password_token(self, user, challenge, session):
+        """
+        Issues a new reset token to the user and queues an e-mail
+        with the verification code.
+
+        :param User user:
+        :param str challenge:
+        :param Session session:
+        """
+        token = self._issue_token(
+            user, UserToken.RESET_PASSWORD, RESET_PASSWORD_TOKEN_EXPIRE_SECONDS, session)
+
+        email_service.queue_reset_password_email(user, token, challenge, session)
 
+    @invalidates_user
     @atomic
     def disable_user(self, user, session):
         """
@@ -150,4 +466,7 @@ class UserRegistry(object):
             .update({'disabled': True})
 
 
-registry = UserRegistry()
+registry = UserRegistry(
+    cache_size=USER_CACHE_SIZE,
+    cache_ttl=USER_CACHE_TTL,
+)
@@ -10,6 +10,9 @@ PROJECT_URL = os.environ['PROJECT_URL']
 SECRET = os.environ['SECRET']
 TOKEN_EXPIRE_SECONDS = int(os.environ['TOKEN_EXPIRE_MINUTES']) * 60
 CONSENT_EXPIRE_SECONDS = int(os.environ['CONSENT_EXPIRE_MINUTES']) * 60
+ACTIVATE_TOKEN_EXPIRE_SECONDS = int(os.environ.get('ACTIVATE_TOKEN_EXPIRE_MINUTES', 10080)) * 60
+RESET_PASSWORD_TOKEN_EXPIRE_SECONDS = int(os.environ.get('RESET_PASSWORD_TOKEN_EXPIRE_MINUTES', 60)) * 60
+TOKEN_PURGE_BATCH_SIZE = int(os.environ.get('TOKEN_PURGE_BATCH_SIZE', 1000))
 FAILURE_REDIRECT_URL = os.environ['FAILURE_REDIRECT_URL']
 
 
@@ -27,14 +30,72 @@ STATIC_DIR = os.path.join(SOURCE_DIR, 'static')
 
 # -- Database ----------------------------------------------------------------
 
+# DATABASE_CONN_POLL_SIZE is the old (misspelled) name, kept for compatibility
+DATABASE_CONN_POOL_SIZE = int(os.environ.get(
+    'DATABASE_CONN_POOL_SIZE', os.environ.get('DATABASE_CONN_POLL_SIZE', 10)))
+DATABASE_POOL_MAX_OVERFLOW = int(os.environ.get('DATABASE_POOL_MAX_OVERFLOW', 10))
+DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE', -1))
+DATABASE_POOL_TIMEOUT = float(os.environ.get('DATABASE_POOL_TIMEOUT', 30))
+
+# When to check that a pooled connection is alive before using it:
+# "always", "idle" (only after DATABASE_POOL_PING_IDLE_SECONDS unused) or "never"
+DATABASE_POOL_PRE_PING = os.environ.get('DATABASE_POOL_PRE_PING', 'always')
+DATABASE_POOL_PING_IDLE_SECONDS = float(os.environ.get('DATABASE_POOL_PING_IDLE_SECONDS', 30))
+
 SQL_ALCHEMY_SETTINGS = {
     'echo': False,
-    'pool_pre_ping': True,
-    'pool_size': int(os.environ['DATABASE_CONN_POLL_SIZE']),
+    'pool_pre_ping': DATABASE_POOL_PRE_PING == 'always',
+    'pool_size': DATABASE_CONN_POOL_SIZE,
+    'max_overflow': DATABASE_POOL_MAX_OVERFLOW,
+    'pool_recycle': DATABASE_POOL_RECYCLE,
+    'pool_timeout': DATABASE_POOL_TIMEOUT,
 }
 
 DATABASE_URI = os.environ['DATABASE_URI']
 
+# Whether to make psycopg2 yield to other greenlets while waiting for
+# PostgreSQL. "auto" enables it when running under gevent.
+DATABASE_COOPERATIVE = os.environ.get('DATABASE_COOPERATIVE', 'auto')
+
+# Report database connections held past the end of a request
+DATABASE_LEAK_DETECTION = os.environ.get(
+    'DATABASE_LEAK_DETECTION', '1' if DEBUG else '0') in ('1', 't', 'true', 'yes')
+
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 30))
+
+
+# -- Passwords ---------------------------------------------------------------
+
+PASSWORD_HASH_POOL_SIZE = int(os.environ.get('PASSWORD_HASH_POOL_SIZE', 2))
+PASSWORD_HASH_BUDGET_MS = float(os.environ.get('PASSWORD_HASH_BUDGET_MS', 100))
+PASSWORD_HASH_MIN_ITERATIONS = int(os.environ.get('PASSWORD_HASH_MIN_ITERATIONS', 100000))
+PASSWORD_HASH_ITERATIONS = int(os.environ['PASSWORD_HASH_ITERATIONS']) \
+    if os.environ.get('PASSWORD_HASH_ITERATIONS') else None
+PASSWORD_HASH_REHASH_TOLERANCE = float(os.environ.get('PASSWORD_HASH_REHASH_TOLERANCE', 0.25))
+
+
+# -- Admission control -------------------------------------------------------
+
+ADMISSION_ROUTE_LIMITS = os.environ.get('ADMISSION_ROUTE_LIMITS', 'login:POST=3,register:POST=1,clients=2')
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 1))
+ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', 1))
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 8))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+ADMISSION_EXEMPT_ROUTES = os.environ.get('ADMISSION_EXEMPT_ROUTES', 'static,metrics')
+
+
+# -- Login throttling --------------------------------------------------------
+
+LOGIN_THROTTLE_ENABLED = os.environ.get('LOGIN_THROTTLE_ENABLED', '1') in ('1', 't', 'true', 'yes')
+LOGIN_THROTTLE_BACKEND = os.environ.get('LOGIN_THROTTLE_BACKEND', 'memory')
+LOGIN_THROTTLE_EMAIL_BURST = int(os.environ.get('LOGIN_THROTTLE_EMAIL_BURST', 10))
+LOGIN_THROTTLE_EMAIL_PER_MINUTE = float(os.environ.get('LOGIN_THROTTLE_EMAIL_PER_MINUTE', 2))
+LOGIN_THROTTLE_IP_BURST = int(os.environ.get('LOGIN_THROTTLE_IP_BURST', 30))
+LOGIN_THROTTLE_IP_PER_MINUTE = float(os.environ.get('LOGIN_THROTTLE_IP_PER_MINUTE', 20))
+LOGIN_THROTTLE_MAX_KEYS = int(os.environ.get('LOGIN_THROTTLE_MAX_KEYS', 100000))
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', 0))
+
 
 # -- Auth/tokens -------------------------------------------------------------
 
@@ -43,6 +104,14 @@ HYDRA_URL = os.environ['HYDRA_URL']
 HYDRA_AUTH_ENDPOINT = f'{HYDRA_URL}/oauth2/auth'
 HYDRA_TOKEN_ENDPOINT = f'{HYDRA_URL}/oauth2/token'
 HYDRA_USER_ENDPOINT = f'{HYDRA_URL}/userinfo'
+HYDRA_POOL_SIZE = int(os.environ.get('HYDRA_POOL_SIZE', 10))
+HYDRA_CONNECT_TIMEOUT = float(os.environ.get('HYDRA_CONNECT_TIMEOUT', 3.05))
+HYDRA_READ_TIMEOUT = float(os.environ.get('HYDRA_READ_TIMEOUT', 10))
+HYDRA_KEEP_ALIVE = os.environ.get('HYDRA_KEEP_ALIVE', '1') in ('1', 't', 'true', 'yes')
+HYDRA_REQUEST_CACHE_SIZE = int(os.environ.get('HYDRA_REQUEST_CACHE_SIZE', 1000))
+HYDRA_REQUEST_CACHE_TTL = float(os.environ.get('HYDRA_REQUEST_CACHE_TTL', 300))
+HYDRA_CLIENT_PAGE_SIZE = int(os.environ.get('HYDRA_CLIENT_PAGE_SIZE', 500))
+HYDRA_CLIENT_INDEX_REFRESH = float(os.environ.get('HYDRA_CLIENT_INDEX_REFRESH', 300))
 HYDRA_WANTED_SCOPES = (
     'openid',
     'offline',
@@ -60,10 +129,41 @@ HYDRA_WANTED_SCOPES = (
 
 AZURE_APP_INSIGHTS_CONN_STRING = os.environ.get(
     'AZURE_APP_INSIGHTS_CONN_STRING')
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED') in ('1', 't', 'true', 'yes')
+PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED') in ('1', 't', 'true', 'yes')
+PROFILER_OUTPUT_DIR = os.environ.get('PROFILER_OUTPUT_DIR', '/tmp/profiles')
+PROFILER_INTERVAL_MS = float(os.environ.get('PROFILER_INTERVAL_MS', 5))
+PROFILER_MIN_INTERVAL = float(os.environ.get('PROFILER_MIN_INTERVAL', 60))
+PROFILER_MAX_SECONDS = float(os.environ.get('PROFILER_MAX_SECONDS', 30))
+WATCHDOG_ENABLED = os.environ.get('WATCHDOG_ENABLED', '1') in ('1', 't', 'true', 'yes')
+WATCHDOG_THRESHOLD_MS = float(os.environ.get('WATCHDOG_THRESHOLD_MS', 100))
+WATCHDOG_LOG_INTERVAL = float(os.environ.get('WATCHDOG_LOG_INTERVAL', 10))
+SERVER_TIMING_HEADER = os.environ.get('SERVER_TIMING_HEADER') in ('1', 't', 'true', 'yes')
+SERVER_TIMING_LOG = os.environ.get('SERVER_TIMING_LOG') in ('1', 't', 'true', 'yes')
+TRACE_SAMPLING_RATE = float(os.environ.get('TRACE_SAMPLING_RATE', 0.1))
+TRACE_SAMPLING_ROUTE_RATES = os.environ.get('TRACE_SAMPLING_ROUTE_RATES', 'metrics=0')
+TRACE_SAMPLING_MODE = os.environ.get('TRACE_SAMPLING_MODE', 'head')
+TRACE_SLOW_THRESHOLD_MS = float(os.environ.get('TRACE_SLOW_THRESHOLD_MS', 1000))
+TRACE_TAIL_MAX_PENDING = int(os.environ.get('TRACE_TAIL_MAX_PENDING', 1000))
+TRACE_EXPORT_QUEUE_SIZE = int(os.environ.get('TRACE_EXPORT_QUEUE_SIZE', 8192))
 
 EMAIL_FROM_NAME = os.environ['EMAIL_FROM_NAME']
 EMAIL_FROM_ADDRESS = os.environ['EMAIL_FROM_ADDRESS']
 SENDGRID_API_KEY = os.environ['SENDGRID_API_KEY']
+SENDGRID_TIMEOUT = float(os.environ.get('SENDGRID_TIMEOUT', 10))
+EMAIL_TRANSPORT = os.environ.get('EMAIL_TRANSPORT', 'sendgrid')
+EMAIL_DISPATCH_BATCH_SIZE = int(os.environ.get('EMAIL_DISPATCH_BATCH_SIZE', 50))
+EMAIL_DISPATCH_INTERVAL = float(os.environ.get('EMAIL_DISPATCH_INTERVAL', 5))
+EMAIL_DISPATCH_MAX_ATTEMPTS = int(os.environ.get('EMAIL_DISPATCH_MAX_ATTEMPTS', 10))
+EMAIL_DISPATCH_BACKOFF = float(os.environ.get('EMAIL_DISPATCH_BACKOFF', 30))
+EMAIL_DISPATCH_MAX_BACKOFF = float(os.environ.get('EMAIL_DISPATCH_MAX_BACKOFF', 3600))
+EMAIL_DISPATCH_METRICS_PORT = int(os.environ.get('EMAIL_DISPATCH_METRICS_PORT', 0))
+EMAIL_OUTBOX_RETENTION_DAYS = float(os.environ.get('EMAIL_OUTBOX_RETENTION_DAYS', 30))
+EMAIL_OUTBOX_PURGE_BATCH_SIZE = int(os.environ.get('EMAIL_OUTBOX_PURGE_BATCH_SIZE', 1000))
+AUDIT_LOG_BATCH_SIZE = int(os.environ.get('AUDIT_LOG_BATCH_SIZE', 500))
+AUDIT_LOG_FLUSH_INTERVAL = float(os.environ.get('AUDIT_LOG_FLUSH_INTERVAL', 2))
+AUDIT_LOG_MAX_BUFFER = int(os.environ.get('AUDIT_LOG_MAX_BUFFER', 10000))
+AUDIT_LOG_RETENTION_MONTHS = int(os.environ.get('AUDIT_LOG_RETENTION_MONTHS', 12))
 TRUSTED_CLIENT_IDS = []
 
 for key in os.environ:
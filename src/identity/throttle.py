@@ -0,0 +1,252 @@
+import time
+import zlib
+import threading
+from collections import OrderedDict
+
+from .hashing import hashing_pool
+from .settings import (
+    LOGIN_THROTTLE_ENABLED,
+    LOGIN_THROTTLE_BACKEND,
+    LOGIN_THROTTLE_EMAIL_BURST,
+    LOGIN_THROTTLE_EMAIL_PER_MINUTE,
+    LOGIN_THROTTLE_IP_BURST,
+    LOGIN_THROTTLE_IP_PER_MINUTE,
+    LOGIN_THROTTLE_MAX_KEYS,
+    PASSWORD_HASH_BUDGET_MS,
+    TRUSTED_PROXY_COUNT,
+)
+
+
+# -- Stores ------------------------------------------------------------------
+
+
+class MemoryStore(object):
+    """
+    Keeps token buckets in memory, per process.
+
+    Buckets are spread over a number of shards, each with its own lock,
+    so concurrent logins rarely wait on each other. Each shard holds a
+    bounded number of buckets, evicting the least recently used.
+    """
+
+    def __init__(self, shards=16, max_keys=100000):
+        """
+        :param int shards:
+        :param int max_keys: Max. number of buckets in total
+        """
+        self.max_keys_per_shard = max(1, max_keys // shards)
+        self.shards = [(threading.Lock(), OrderedDict()) for _ in range(shards)]
+
+    def take(self, key, capacity, rate):
+        """
+        Takes a token from the bucket.
+
+        :param str key:
+        :param float capacity: Max. number of tokens in the bucket
+        :param float rate: Tokens added per second
+        :return: Seconds until a token is available, 0 if one was taken
+        :rtype: float
+        """
+        lock, buckets = self.shards[zlib.crc32(key.encode()) % len(self.shards)]
+        now = time.monotonic()
+
+        with lock:
+            tokens, updated = buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                retry_after = 0.0
+            else:
+                retry_after = (1 - tokens) / rate
+
+            buckets[key] = (tokens, now)
+
+            if len(buckets) > self.max_keys_per_shard:
+                buckets.popitem(last=False)
+
+        return retry_after
+
+
+class RedisStore(object):
+    """
+    Keeps token buckets in Redis, shared by all processes. Each bucket
+    is updated atomically by a Lua script, and expires once it would
+    be full again.
+
+    Requires the "redis" package, which is only imported when used.
+    Use MemoryStore for local development.
+    """
+
+    SCRIPT = """
+        local capacity = tonumber(ARGV[1])
+        local rate = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or capacity
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+        local taken = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            taken = 1
+        end
+        redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate))
+        return {taken, tostring(tokens)}
+    """
+
+    def __init__(self, url, prefix='identity:throttle:'):
+        """
+        :param str url: ie. redis://localhost:6379/0
+        :param str prefix: Prefix of the keys in Redis
+        """
+        import redis
+
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def take(self, key, capacity, rate):
+        """
+        Takes a token from the bucket.
+
+        :param str key:
+        :param float capacity: Max. number of tokens in the bucket
+        :param float rate: Tokens added per second
+        :return: Seconds until a token is available, 0 if one was taken
+        :rtype: float
+        """
+        taken, tokens = self.script(
+            keys=[self.prefix + key],
+            args=[capacity, rate, time.time()],
+        )
+
+        return 0.0 if taken else (1 - float(tokens)) / rate
+
+
+def create_store(uri, max_keys):
+    """
+    Creates a store from a URI, one of:
+
+        memory
+        redis://host:port/db
+
+    :param str uri:
+    :param int max_keys: Max. number of buckets in memory
+    """
+    if uri == 'memory':
+        return MemoryStore(max_keys=max_keys)
+    elif uri.startswith(('redis://', 'rediss://')):
+        return RedisStore(uri)
+    else:
+        raise ValueError(f'Unknown login throttle backend: {uri}')
+
+
+# -- Throttle ----------------------------------------------------------------
+
+
+class LoginThrottle(object):
+    """
+    Limits login attempts per e-mail and per source IP with token
+    buckets, so brute-force attempts and runaway retry loops are turned
+    away before the password is hashed.
+
+    Each attempt takes a token from both the IP's and the e-mail's
+    bucket. Attempts from a throttled IP don't take tokens from the
+    e-mail's bucket.
+
+    Limiting per IP is only safe when the client's IP is known. Behind
+    a reverse proxy without TRUSTED_PROXY_COUNT, every request appears
+    to come from the proxy, and a single client could use up the bucket
+    of everyone, so per-IP limits can be turned off with per_ip.
+    """
+
+    def __init__(self, store, email_burst, email_per_minute, ip_burst,
+                 ip_per_minute, per_ip=True, enabled=True):
+        """
+        :param store: MemoryStore or RedisStore
+        :param int email_burst: Max. attempts in a row per e-mail
+        :param float email_per_minute: Sustained attempts per e-mail
+        :param int ip_burst: Max. attempts in a row per IP
+        :param float ip_per_minute: Sustained attempts per IP
+        :param bool per_ip: Whether to limit attempts per IP
+        :param bool enabled:
+        """
+        self.store = store
+        self.email_burst = email_burst
+        self.email_rate = email_per_minute / 60
+        self.ip_burst = ip_burst
+        self.ip_rate = ip_per_minute / 60
+        self.per_ip = per_ip
+        self.enabled = enabled
+
+        # Metrics
+        self.allowed = 0
+        self.throttled_email = 0
+        self.throttled_ip = 0
+
+    def check(self, email, ip):
+        """
+        Registers a login attempt.
+
+        :param str email:
+        :param str ip:
+        :return: Seconds until the next attempt is allowed, 0 if this
+            attempt is allowed
+        :rtype: float
+        """
+        if not self.enabled:
+            return 0.0
+
+        if self.per_ip:
+            retry_after = self.store.take(f'ip:{ip}', self.ip_burst, self.ip_rate)
+
+            if retry_after:
+                self.throttled_ip += 1
+                return retry_after
+
+        retry_after = self.store.take(
+            f'email:{email.strip().lower()}', self.email_burst, self.email_rate)
+
+        if retry_after:
+            self.throttled_email += 1
+            return retry_after
+
+        self.allowed += 1
+        return 0.0
+
+    def stats(self):
+        """
+        The CPU time saved is estimated from the average time spent per
+        password hash, or the hashing budget before any hashes are done.
+
+        :rtype: dict
+        """
+        pool = hashing_pool.stats()
+        throttled = self.throttled_email + self.throttled_ip
+
+        if pool['calls']:
+            seconds_per_hash = pool['run_seconds'] / pool['calls']
+        else:
+            seconds_per_hash = PASSWORD_HASH_BUDGET_MS / 1000
+
+        return {
+            'allowed': self.allowed,
+            'throttled': throttled,
+            'throttled_email': self.throttled_email,
+            'throttled_ip': self.throttled_ip,
+            'hashes_avoided': throttled,
+            'hash_seconds_avoided': throttled * seconds_per_hash,
+        }
+
+
+login_throttle = LoginThrottle(
+    store=create_store(LOGIN_THROTTLE_BACKEND, LOGIN_THROTTLE_MAX_KEYS),
+    email_burst=LOGIN_THROTTLE_EMAIL_BURST,
+    email_per_minute=LOGIN_THROTTLE_EMAIL_PER_MINUTE,
+    ip_burst=LOGIN_THROTTLE_IP_BURST,
+    ip_per_minute=LOGIN_THROTTLE_IP_PER_MINUTE,
+    per_ip=TRUSTED_PROXY_COUNT > 0,
+    enabled=LOGIN_THROTTLE_ENABLED,
+)
@@ -0,0 +1,89 @@
+import json
+import time
+import logging
+
+import flask
+
+from .settings import PROJECT_NAME, SERVER_TIMING_HEADER, SERVER_TIMING_LOG
+
+
+logger = logging.getLogger(f'{PROJECT_NAME}.timing')
+
+ENABLED = SERVER_TIMING_HEADER or SERVER_TIMING_LOG
+
+# Phases in the order they are reported
+PHASES = ('hydra', 'db', 'hash', 'render')
+
+
+def add(phase, seconds):
+    """
+    Adds time spent in a phase (ie. "hydra" or "db") to the current
+    request's timings. Does nothing outside of requests, or when
+    Server-Timing is disabled.
+
+    :param str phase: One of PHASES
+    :param float seconds:
+    """
+    if ENABLED and flask.has_request_context():
+        timings = flask.g.setdefault('timings', {})
+        count, total = timings.get(phase, (0, 0.0))
+        timings[phase] = (count + 1, total + seconds)
+
+
+class phase(object):
+    """
+    Context manager which adds the time spent within it to a phase
+    of the current request's timings.
+    """
+
+    def __init__(self, name):
+        """
+        :param str name: One of PHASES
+        """
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        add(self.name, time.perf_counter() - self.started)
+
+
+def report(response, total):
+    """
+    Adds the current request's timings to the response as a
+    Server-Timing header, and/or logs them, depending on settings.
+
+    :param flask.Response response:
+    :param float total: Seconds spent on the request so far
+    """
+    timings = flask.g.pop('timings', {})
+
+    if SERVER_TIMING_HEADER:
+        metrics = []
+
+        for name in PHASES:
+            if name in timings:
+                count, seconds = timings[name]
+                calls = 'call' if count == 1 else 'calls'
+                metrics.append(f'{name};dur={seconds * 1000:.1f};desc="{count} {calls}"')
+
+        metrics.append(f'total;dur={total * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(metrics)
+
+    if SERVER_TIMING_LOG:
+        line = {
+            'route': flask.request.endpoint,
+            'method': flask.request.method,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 1),
+        }
+
+        for name in PHASES:
+            count, seconds = timings.get(name, (0, 0.0))
+            line[f'{name}_ms'] = round(seconds * 1000, 1)
+            line[f'{name}_count'] = count
+
+        logger.info(json.dumps(line))
@@ -0,0 +1,335 @@
+import queue
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import flask
+from opencensus.trace.base_exporter import Exporter
+from opencensus.trace.samplers import Sampler
+from opencensus.trace.propagation.trace_context_http_header_format import TraceContextPropagator
+from opencensus.trace.span import SpanKind
+
+from .metrics import metrics
+from .settings import PROJECT_NAME
+
+
+logger = logging.getLogger(f'{PROJECT_NAME}.tracing')
+
+
+TRACE_SPANS_DROPPED = metrics.counter(
+    'trace_spans_dropped_total',
+    'Spans dropped because the export queue was full',
+)
+
+
+class RouteSampler(Sampler):
+    """
+    Samples a fraction of the requests, with a rate per route (endpoint)
+    and a default rate for the rest. Requests which are already sampled
+    by the caller (see the "traceparent" header) are always sampled.
+
+    The decision is derived from the trace ID, so it is the same
+    wherever it is made for the same trace.
+
+    In tail mode, every request is traced, and the decision is left to
+    TailSamplingExporter, which also keeps slow and failed requests.
+    Whether the caller sampled the request is remembered for the
+    request, as the trace is then marked as sampled regardless.
+    """
+
+    def __init__(self, rate, route_rates, tail=False):
+        """
+        :param float rate: Default fraction of requests to sample
+        :param dict[str, float] route_rates: Fraction per endpoint
+        :param bool tail: Whether to use tail mode
+        """
+        self.rate = rate
+        self.route_rates = route_rates
+        self.tail = tail
+
+    def should_sample(self, span_context):
+        """
+        :param opencensus.trace.span_context.SpanContext span_context:
+        :rtype: bool
+        """
+        sampled = span_context.trace_options.get_enabled()
+
+        if self.tail:
+            if flask.has_request_context():
+                flask.g.trace_sampled_upstream = sampled
+            return True
+        elif sampled:
+            return True
+
+        return self.sample(span_context.trace_id, _current_endpoint())
+
+    def sample(self, trace_id, endpoint):
+        """
+        :param str trace_id:
+        :param str endpoint:
+        :rtype: bool
+        """
+        rate = self.route_rates.get(endpoint, self.rate)
+        return int(trace_id[16:], 16) <= rate * 0xffffffffffffffff
+
+
+class TailSamplingExporter(Exporter):
+    """
+    Holds back the spans of each trace until the request's (server)
+    span ends, and then decides whether to export the trace: it is kept
+    if the caller sampled it, or if the request was slow or failed, and
+    otherwise sampled by the sampler's rates.
+
+    Child spans (ie. of requests to Hydra or database statements) end
+    before the request's span, so they are all held back when the
+    decision is made. Traces still pending when the buffer is full are
+    dropped, oldest first.
+    """
+
+    def __init__(self, exporter, sampler, slow_seconds, max_pending):
+        """
+        :param Exporter exporter: Exporter of the kept traces
+        :param RouteSampler sampler:
+        :param float slow_seconds: Always keep requests slower than this
+        :param int max_pending: Max. number of traces to hold back
+        """
+        self.exporter = exporter
+        self.sampler = sampler
+        self.slow_seconds = slow_seconds
+        self.max_pending = max_pending
+        self.pending = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.kept_upstream = 0
+        self.kept_slow = 0
+        self.kept_error = 0
+        self.kept_sampled = 0
+        self.discarded = 0
+        self.evicted = 0
+
+    def export(self, span_datas):
+        """
+        :param list[opencensus.trace.span_data.SpanData] span_datas:
+        """
+        for span_data in span_datas:
+            trace_id = span_data.context.trace_id
+
+            with self._lock:
+                spans = self.pending.setdefault(trace_id, [])
+                spans.append(span_data)
+
+                if span_data.span_kind == SpanKind.SERVER:
+                    del self.pending[trace_id]
+                else:
+                    spans = None
+                    if len(self.pending) > self.max_pending:
+                        self.pending.popitem(last=False)
+                        self.evicted += 1
+
+            if spans is not None and self.keep(span_data):
+                self.exporter.export(spans)
+
+    def keep(self, span_data):
+        """
+        :param opencensus.trace.span_data.SpanData span_data: The
+            request's (server) span
+        :rtype: bool
+        """
+        status_code = span_data.attributes.get('http.status_code', 200)
+
+        if _sampled_upstream():
+            self.kept_upstream += 1
+            return True
+        elif getattr(span_data.status, 'code', 0) or int(status_code) >= 500:
+            self.kept_error += 1
+            return True
+        elif _duration(span_data) >= self.slow_seconds:
+            self.kept_slow += 1
+            return True
+        elif self.sampler.sample(span_data.context.trace_id, _current_endpoint()):
+            self.kept_sampled += 1
+            return True
+        else:
+            self.discarded += 1
+            return False
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'pending': len(self.pending),
+            'kept_upstream': self.kept_upstream,
+            'kept_slow': self.kept_slow,
+            'kept_error': self.kept_error,
+            'kept_sampled': self.kept_sampled,
+            'discarded': self.discarded,
+            'evicted': self.evicted,
+        }
+
+
+class SampledFlagPropagator(TraceContextPropagator):
+    """
+    Propagates the trace to downstream services (ie. Hydra) with the
+    sampled flag set by the sampler's rates, rather than by whether
+    this service traces the request.
+
+    In tail mode every request is traced, so without this, downstream
+    services would be asked to trace every request too.
+    """
+
+    def __init__(self, sampler):
+        """
+        :param RouteSampler sampler:
+        """
+        self.sampler = sampler
+
+    def to_headers(self, span_context):
+        """
+        :param opencensus.trace.span_context.SpanContext span_context:
+        :rtype: dict
+        """
+        headers = super(SampledFlagPropagator, self).to_headers(span_context)
+
+        if self.sampler.tail:
+            sampled = _sampled_upstream() or self.sampler.sample(
+                span_context.trace_id, _current_endpoint())
+            traceparent = headers['traceparent']
+            headers['traceparent'] = traceparent[:-2] + ('01' if sampled else '00')
+
+        return headers
+
+
+class QueueExporter(Exporter):
+    """
+    Hands spans to a background thread, which sends them in batches
+    with the wrapped exporter's emit(), so exporting never adds latency
+    to a request.
+
+    The queue is bounded. When it is full, spans are dropped and counted
+    (trace_spans_dropped_total) rather than making the request wait.
+    The wrapped exporter's own queue is bypassed, as it drops spans
+    without counting them.
+    """
+
+    def __init__(self, exporter, max_size, batch_size=100):
+        """
+        :param opencensus.ext.azure.trace_exporter.AzureExporter exporter:
+        :param int max_size: Max. number of spans in the queue
+        :param int batch_size: Max. number of spans per batch
+        """
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.queued = 0
+        self.exported = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def export(self, span_datas):
+        """
+        :param list[opencensus.trace.span_data.SpanData] span_datas:
+        """
+        self.start()
+
+        for span_data in span_datas:
+            try:
+                self.queue.put_nowait(span_data)
+            except queue.Full:
+                self.dropped += 1
+                TRACE_SPANS_DROPPED.inc()
+            else:
+                self.queued += 1
+
+    def start(self):
+        """
+        Starts the background thread, unless already started.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._export_forever, daemon=True)
+                self._thread.start()
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'queue_size': self.queue.qsize(),
+            'queued': self.queued,
+            'exported': self.exported,
+            'dropped': self.dropped,
+            'errors': self.errors,
+        }
+
+    def _export_forever(self):
+        while True:
+            batch = [self.queue.get()]
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self.exporter.emit(batch)
+            except Exception:
+                logger.exception(f'Failed to export {len(batch)} spans')
+                self.errors += 1
+            else:
+                self.exported += len(batch)
+
+
+def parse_route_rates(value):
+    """
+    Parses sampling rates per route on the form "login=0.5,metrics=0".
+
+    :param str value:
+    :rtype: dict[str, float]
+    """
+    rates = {}
+
+    for item in value.split(','):
+        if item.strip():
+            endpoint, rate = item.split('=')
+            rates[endpoint.strip()] = float(rate)
+
+    return rates
+
+
+def _current_endpoint():
+    """
+    :rtype: str
+    """
+    if flask.has_request_context():
+        return flask.request.endpoint
+    return None
+
+
+def _sampled_upstream():
+    """
+    Returns whether the caller sampled the current request (tail mode).
+
+    :rtype: bool
+    """
+    if flask.has_request_context():
+        return flask.g.get('trace_sampled_upstream', False)
+    return False
+
+
+def _duration(span_data):
+    """
+    :param opencensus.trace.span_data.SpanData span_data:
+    :return: Duration in seconds
+    :rtype: float
+    """
+    start = datetime.strptime(span_data.start_time, '%Y-%m-%dT%H:%M:%S.%fZ')
+    end = datetime.strptime(span_data.end_time, '%Y-%m-%dT%H:%M:%S.%fZ')
+    return (end - start).total_seconds()
@@ -0,0 +1,247 @@
+import os
+import sys
+import time
+import logging
+import traceback
+
+from .metrics import metrics, DEFAULT_BUCKETS
+from .concurrency import is_gevent_patched
+from .settings import (
+    PROJECT_NAME,
+    WATCHDOG_ENABLED,
+    WATCHDOG_THRESHOLD_MS,
+    WATCHDOG_LOG_INTERVAL,
+)
+
+
+logger = logging.getLogger(f'{PROJECT_NAME}.watchdog')
+
+
+EVENT_LOOP_BLOCKED = metrics.counter(
+    'event_loop_blocked_total',
+    'Times the event loop was blocked for longer than the threshold, '
+    'per function it was blocked in ("unknown" if not caught in the act)',
+    labels=('frame',),
+)
+
+EVENT_LOOP_BLOCKED_SECONDS = metrics.histogram(
+    'event_loop_blocked_seconds',
+    'Time the event loop was blocked, when longer than the threshold',
+    buckets=DEFAULT_BUCKETS,
+)
+
+
+# Frames within this directory are preferred when naming what blocked
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Watchdog(object):
+    """
+    Detects when gevent's event loop (the hub) is blocked, ie. by CPU
+    bound code or a call which doesn't yield to other greenlets, which
+    delays every other request handled by the process.
+
+    A timer on the event loop beats every interval. When a beat is late
+    by more than the threshold, the loop was blocked for that long.
+    Meanwhile, a native thread watches the beats, and when one is overdue
+    it captures the stack of the code blocking the loop.
+
+    Blocks are counted per function and timed, and their stacks are
+    logged, at most once per log_interval seconds. Logging happens in a
+    greenlet spawned by the loop, never from the native thread.
+
+    Only active when gevent has patched the standard library, ie. in
+    gunicorn's gevent worker.
+    """
+
+    def __init__(self, enabled, threshold_ms, log_interval):
+        """
+        :param bool enabled:
+        :param float threshold_ms: Report blocks longer than this
+        :param float log_interval: Min. seconds between logged stacks
+        """
+        self.enabled = enabled
+        self.threshold = threshold_ms / 1000
+        self.interval = max(0.01, self.threshold / 4)
+        self.log_interval = log_interval
+        self.pid = None
+        self.thread_id = None
+        self.last_beat = None
+        self.last_logged = None
+        self.captured = None
+        self._timer = None
+
+        # Metrics
+        self.blocks = 0
+        self.blocked_seconds = 0.0
+        self.max_blocked_seconds = 0.0
+        self.stacks_logged = 0
+        self.stacks_suppressed = 0
+
+    @property
+    def running(self):
+        """
+        :rtype: bool
+        """
+        return self.pid == os.getpid()
+
+    def start(self):
+        """
+        Starts watching the event loop of the current (main) thread.
+        Does nothing if disabled, not running under gevent, or already
+        started in this process.
+        """
+        if not self.enabled or not is_gevent_patched() or self.running:
+            return
+
+        from gevent import get_hub
+        from gevent.monkey import get_original
+
+        self.pid = os.getpid()
+        self.thread_id = get_original('_thread', 'get_ident')()
+        self.last_beat = time.monotonic()
+
+        # The timer must not keep the event loop alive on its own
+        self._timer = get_hub().loop.timer(self.interval, self.interval)
+        self._timer.ref = False
+        self._timer.start(self._beat)
+
+        get_original('_thread', 'start_new_thread')(self._watch_forever, ())
+
+        logger.info(f'Watching the event loop for blocks longer than '
+                    f'{self.threshold * 1000:.0f} ms')
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'running': self.running,
+            'blocks': self.blocks,
+            'blocked_seconds': self.blocked_seconds,
+            'max_blocked_seconds': self.max_blocked_seconds,
+            'stacks_logged': self.stacks_logged,
+            'stacks_suppressed': self.stacks_suppressed,
+        }
+
+    def _beat(self):
+        """
+        Runs on the event loop every interval.
+        """
+        now = time.monotonic()
+        started = self.last_beat
+        blocked = now - started - self.interval
+        self.last_beat = now
+
+        if blocked > self.threshold:
+            captured, self.captured = self.captured, None
+
+            # Only use a stack captured during this block
+            if captured is not None and captured[0] == started:
+                stack = captured[1]
+            else:
+                stack = None
+
+            self._blocked(blocked, stack)
+
+    def _blocked(self, seconds, stack):
+        """
+        :param float seconds:
+        :param list[(str, int, str)] stack: (file name, line, function)
+            of each frame, outermost first, or None
+        """
+        frame = _blocking_frame(stack) if stack else 'unknown'
+
+        self.blocks += 1
+        self.blocked_seconds += seconds
+        self.max_blocked_seconds = max(self.max_blocked_seconds, seconds)
+        EVENT_LOOP_BLOCKED.inc(frame=frame)
+        EVENT_LOOP_BLOCKED_SECONDS.observe(seconds)
+
+        now = time.monotonic()
+
+        if self.last_logged is not None and now - self.last_logged < self.log_interval:
+            self.stacks_suppressed += 1
+            return
+
+        self.last_logged = now
+        self.stacks_logged += 1
+
+        # Logging may take locks which would block the event loop, so
+        # it is done in its own greenlet
+        import gevent
+        gevent.spawn(self._log, seconds, frame, stack)
+
+    def _log(self, seconds, frame, stack):
+        """
+        :param float seconds:
+        :param str frame:
+        :param list[(str, int, str)] stack:
+        """
+        message = f'Event loop was blocked for {seconds * 1000:.0f} ms in {frame}'
+
+        if stack:
+            summary = traceback.StackSummary.from_list(
+                [(filename, line, name, None) for filename, line, name in stack])
+            message += ':\n' + ''.join(summary.format()).rstrip()
+
+        logger.warning(message)
+
+    def _watch_forever(self):
+        """
+        Runs in a native thread, and captures the stack of the main
+        thread when a beat is overdue, once per block.
+        """
+        from gevent.monkey import get_original
+        sleep = get_original('time', 'sleep')
+
+        while True:
+            sleep(self.interval)
+
+            started = self.last_beat
+
+            if time.monotonic() - started > self.interval + self.threshold \
+                    and (self.captured is None or self.captured[0] != started):
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    self.captured = (started, _extract(frame))
+
+
+def _extract(frame):
+    """
+    :param frame:
+    :return: (file name, line, function) of each frame, outermost first
+    :rtype: list[(str, int, str)]
+    """
+    stack = []
+
+    while frame is not None:
+        stack.append((frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+        frame = frame.f_back
+
+    stack.reverse()
+    return stack
+
+
+def _blocking_frame(stack):
+    """
+    Names the function the event loop was blocked in: the innermost
+    function of this project, or the innermost function if none.
+
+    :param list[(str, int, str)] stack:
+    :rtype: str
+    """
+    for filename, line, name in reversed(stack):
+        if filename.startswith(PACKAGE_DIR):
+            break
+    else:
+        filename, line, name = stack[-1]
+
+    return f'{name} ({os.path.basename(filename)})'
+
+
+watchdog = Watchdog(
+    enabled=WATCHDOG_ENABLED,
+    threshold_ms=WATCHDOG_THRESHOLD_MS,
+    log_interval=WATCHDOG_LOG_INTERVAL,
+)
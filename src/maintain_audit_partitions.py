@@ -0,0 +1,20 @@
+import logging
+import argparse
+
+from identity.audit import create_partitions, drop_partitions
+from identity.settings import AUDIT_LOG_RETENTION_MONTHS
+
+
+parser = argparse.ArgumentParser(description='Create upcoming and drop expired monthly partitions of the audit log')
+parser.add_argument('--months-ahead', type=int, default=3, help='Number of months ahead to create partitions for')
+parser.add_argument('--retention-months', type=int, default=AUDIT_LOG_RETENTION_MONTHS, help='Number of past months to keep')
+
+
+logging.basicConfig(level=logging.INFO)
+args = parser.parse_args()
+
+for name in create_partitions(args.months_ahead):
+    logging.info(f'Created partition {name}')
+
+for name in drop_partitions(args.retention_months):
+    logging.info(f'Dropped partition {name}')
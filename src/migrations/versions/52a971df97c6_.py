@@ -0,0 +1,81 @@
+"""Index audit of the user table
+
+Drops indexes which duplicate the primary key and unique constraints,
+and the index on phone, which no query filters or sorts by. Replaces the unique constraint on e-mail with a unique index on
+lower(email), and adds partial indexes on the token columns.
+
+Indexes are created and dropped CONCURRENTLY, so the table stays
+available for reads and writes while the migration runs. A failed
+concurrent build leaves an INVALID index behind, which is dropped and
+rebuilt when the migration is run again.
+
+Revision ID: 52a971df97c6
+Revises: 1e7f14aa1075
+Create Date: 2026-10-18 06:58:12.631904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '52a971df97c6'
+down_revision = '1e7f14aa1075'
+branch_labels = None
+depends_on = None
+
+
+def create_index_concurrently(name, sql):
+    """
+    Creates an index CONCURRENTLY, unless a valid index by that name
+    exists already. An invalid index, left behind by a failed build,
+    is dropped and built again (IF NOT EXISTS would skip it).
+
+    :param str name:
+    :param str sql: CREATE [UNIQUE] INDEX CONCURRENTLY statement
+    """
+    valid = op.get_bind().execute(
+        sa.text(
+            'SELECT pg_index.indisvalid FROM pg_index '
+            'JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+            'WHERE pg_class.relname = :name'
+        ),
+        name=name,
+    ).scalar()
+
+    if valid:
+        return
+    elif valid is not None:
+        op.execute(f'DROP INDEX CONCURRENTLY {name}')
+
+    op.execute(sql)
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        create_index_concurrently('ix_user_email_lower', 'CREATE UNIQUE INDEX CONCURRENTLY ix_user_email_lower ON "user" (lower(email))')
+        create_index_concurrently('ix_user_activate_token', 'CREATE INDEX CONCURRENTLY ix_user_activate_token ON "user" (activate_token) WHERE activate_token IS NOT NULL')
+        create_index_concurrently('ix_user_reset_password_token', 'CREATE INDEX CONCURRENTLY ix_user_reset_password_token ON "user" (reset_password_token) WHERE reset_password_token IS NOT NULL')
+
+    op.drop_constraint('user_email_key', 'user', type_='unique')
+
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_user_id')
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_user_email')
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_user_subject')
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_user_phone')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        create_index_concurrently('ix_user_phone', 'CREATE INDEX CONCURRENTLY ix_user_phone ON "user" (phone)')
+        create_index_concurrently('ix_user_subject', 'CREATE INDEX CONCURRENTLY ix_user_subject ON "user" (subject)')
+        create_index_concurrently('ix_user_email', 'CREATE INDEX CONCURRENTLY ix_user_email ON "user" (email)')
+        create_index_concurrently('ix_user_id', 'CREATE INDEX CONCURRENTLY ix_user_id ON "user" (id)')
+
+    op.create_unique_constraint('user_email_key', 'user', ['email'])
+
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_user_reset_password_token')
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_user_activate_token')
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_user_email_lower')
@@ -0,0 +1,48 @@
+"""Remove the default partition of audit_event
+
+With a default partition, creating the partition of a month fails if
+events for that month have already landed in the default partition,
+and otherwise scans the default partition under an exclusive lock.
+Monthly partitions are created ahead of time instead.
+
+Events in the default partition are moved to monthly partitions, which
+are created as needed.
+
+Revision ID: e8b3f1a07c92
+Revises: d41e8a2c6f57
+Create Date: 2026-10-18 09:48:03.116204
+
+"""
+from datetime import timedelta
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8b3f1a07c92'
+down_revision = 'd41e8a2c6f57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    conn = op.get_bind()
+
+    op.execute('ALTER TABLE audit_event DETACH PARTITION audit_event_default')
+
+    months = conn.execute(
+        "SELECT DISTINCT date_trunc('month', created)::date "
+        "FROM audit_event_default"
+    ).fetchall()
+
+    for (month,) in months:
+        next_month = (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+        op.execute(
+            f'CREATE TABLE audit_event_{month:%Y_%m} PARTITION OF audit_event '
+            f"FOR VALUES FROM ('{month}') TO ('{next_month}')")
+
+    op.execute('INSERT INTO audit_event SELECT * FROM audit_event_default')
+    op.execute('DROP TABLE audit_event_default')
+
+
+def downgrade():
+    op.execute('CREATE TABLE audit_event_default PARTITION OF audit_event DEFAULT')
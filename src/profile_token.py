@@ -0,0 +1,16 @@
+import jwt
+import time
+import argparse
+
+from identity.settings import SECRET
+from identity.profiler import TOKEN_AUDIENCE
+
+
+parser = argparse.ArgumentParser(description='Print a token for profiling requests, to send in the X-Profile header')
+parser.add_argument('--minutes', type=int, default=5, help='Number of minutes the token is valid')
+
+
+args = parser.parse_args()
+token = jwt.encode({'aud': TOKEN_AUDIENCE, 'exp': int(time.time()) + args.minutes * 60}, SECRET, algorithm='HS256')
+
+print(token.decode() if isinstance(token, bytes) else token)
@@ -0,0 +1,48 @@
+import time
+import logging
+import argparse
+
+from identity.registry import registry
+from identity.settings import TOKEN_PURGE_BATCH_SIZE
+
+
+parser = argparse.ArgumentParser(description='Delete expired activation and reset password tokens')
+parser.add_argument('--batch-size', type=int, default=TOKEN_PURGE_BATCH_SIZE, help='Number of tokens to delete per transaction')
+parser.add_argument('--pause', type=float, default=0.1, help='Seconds to pause between batches')
+parser.add_argument('--loop', type=float, metavar='SECONDS', help='Keep running, purging again every SECONDS')
+
+
+def purge_expired_tokens(batch_size, pause):
+    """
+    Deletes expired tokens in batches, each in its own short transaction,
+    so the purge never holds many row locks or a long transaction.
+
+    :param int batch_size:
+    :param float pause:
+    :return: Number of tokens deleted
+    :rtype: int
+    """
+    total = 0
+
+    while True:
+        count = registry.purge_expired_tokens(batch_size)
+        total += count
+
+        if count < batch_size:
+            return total
+
+        time.sleep(pause)
+
+
+logging.basicConfig(level=logging.INFO)
+args = parser.parse_args()
+
+while True:
+    started = time.perf_counter()
+    count = purge_expired_tokens(args.batch_size, args.pause)
+    logging.info(f'Purged {count} expired tokens in {time.perf_counter() - started:.1f} seconds')
+
+    if args.loop is None:
+        break
+
+    time.sleep(args.loop)
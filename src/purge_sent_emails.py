@@ -0,0 +1,51 @@
+import time
+import logging
+import argparse
+
+from identity.outbox import dispatcher
+from identity.settings import EMAIL_OUTBOX_RETENTION_DAYS, EMAIL_OUTBOX_PURGE_BATCH_SIZE
+
+
+parser = argparse.ArgumentParser(description='Delete sent and failed e-mails from the outbox')
+parser.add_argument('--retention-days', type=float, default=EMAIL_OUTBOX_RETENTION_DAYS, help='Keep e-mails created within this many days')
+parser.add_argument('--batch-size', type=int, default=EMAIL_OUTBOX_PURGE_BATCH_SIZE, help='Number of e-mails to delete per transaction')
+parser.add_argument('--pause', type=float, default=0.1, help='Seconds to pause between batches')
+parser.add_argument('--loop', type=float, metavar='SECONDS', help='Keep running, purging again every SECONDS')
+
+
+def purge_sent_emails(retention_days, batch_size, pause):
+    """
+    Deletes sent and failed e-mails in batches, each in its own short
+    transaction, so the purge never holds many row locks or a long
+    transaction.
+
+    :param float retention_days:
+    :param int batch_size:
+    :param float pause:
+    :return: Number of e-mails deleted
+    :rtype: int
+    """
+    total = 0
+
+    while True:
+        count = dispatcher.purge_sent(retention_days, batch_size)
+        total += count
+
+        if count < batch_size:
+            return total
+
+        time.sleep(pause)
+
+
+logging.basicConfig(level=logging.INFO)
+args = parser.parse_args()
+
+while True:
+    started = time.perf_counter()
+    count = purge_sent_emails(args.retention_days, args.batch_size, args.pause)
+    logging.info(f'Purged {count} sent and failed e-mails in {time.perf_counter() - started:.1f} seconds')
+
+    if args.loop is None:
+        break
+
+    time.sleep(args.loop)
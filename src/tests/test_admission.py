@@ -0,0 +1,52 @@
+from identity.admission import AdmissionController, parse_route_limits
+
+
+def create_admission(**kwargs):
+    options = dict(
+        route_limits={},
+        queue_timeout=0,
+        max_queue=0,
+        max_in_flight=1,
+        retry_after=1,
+        exempt=('static', 'metrics'),
+    )
+    options.update(kwargs)
+    return AdmissionController(**options)
+
+
+def test__AdmissionController__admit__max_in_flight_reached__sheds_requests():
+    admission = create_admission()
+
+    assert admission.admit('login', 'GET') is True
+    assert admission.admit('terms', 'GET') is False
+    assert admission.stats()['shed'] == 1
+
+    admission.release('login', 'GET')
+
+    assert admission.admit('terms', 'GET') is True
+
+
+def test__AdmissionController__admit__exempt_routes__never_shed_or_counted():
+    admission = create_admission()
+    admission.admit('login', 'GET')
+
+    assert admission.admit('static', 'GET') is True
+    assert admission.admit('metrics', 'GET') is True
+    assert admission.stats()['in_flight'] == 1
+    assert admission.stats()['shed'] == 0
+
+    admission.release('static', 'GET')
+    admission.release('metrics', 'GET')
+
+    assert admission.stats()['in_flight'] == 1
+
+
+def test__AdmissionController__admit__bulkhead_full__rejects_request():
+    admission = create_admission(
+        route_limits=parse_route_limits('login:POST=1'),
+        max_in_flight=0,
+    )
+
+    assert admission.admit('login', 'POST') is True
+    assert admission.admit('login', 'POST') is False
+    assert admission.admit('login', 'GET') is True
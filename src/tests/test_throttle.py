@@ -0,0 +1,160 @@
+import pytest
+
+from identity import throttle
+from identity.throttle import MemoryStore, LoginThrottle, create_store
+
+
+class FakeTime(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(throttle, 'time', fake)
+    return fake
+
+
+# -- MemoryStore -------------------------------------------------------------
+
+
+def test__MemoryStore__take__allows_burst_then_throttles(clock):
+    store = MemoryStore()
+
+    assert [store.take('key', 3, 1.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert store.take('key', 3, 1.0) == pytest.approx(1.0)
+
+
+def test__MemoryStore__take__refills_at_rate(clock):
+    store = MemoryStore()
+
+    for _ in range(2):
+        store.take('key', 2, 0.5)
+
+    clock.now += 1
+    assert store.take('key', 2, 0.5) == pytest.approx(1.0)
+
+    clock.now += 1
+    assert store.take('key', 2, 0.5) == 0.0
+
+
+def test__MemoryStore__take__never_refills_beyond_capacity(clock):
+    store = MemoryStore()
+    store.take('key', 2, 1.0)
+
+    clock.now += 3600
+
+    assert [store.take('key', 2, 1.0) for _ in range(2)] == [0.0, 0.0]
+    assert store.take('key', 2, 1.0) > 0
+
+
+def test__MemoryStore__take__keeps_keys_apart(clock):
+    store = MemoryStore()
+    store.take('a', 1, 1.0)
+
+    assert store.take('a', 1, 1.0) > 0
+    assert store.take('b', 1, 1.0) == 0.0
+
+
+def test__MemoryStore__take__evicts_least_recently_used(clock):
+    store = MemoryStore(shards=1, max_keys=2)
+    store.take('a', 1, 1.0)
+    store.take('b', 1, 1.0)
+    store.take('a', 1, 1.0)
+    store.take('c', 1, 1.0)
+
+    # "a" was used more recently than "b", so "b" was evicted
+    assert store.take('a', 1, 1.0) > 0
+    assert store.take('b', 1, 1.0) == 0.0
+
+
+def test__create_store__unknown_backend__raises_ValueError():
+    with pytest.raises(ValueError):
+        create_store('memcached://localhost', 100)
+
+
+# -- LoginThrottle -----------------------------------------------------------
+
+
+def create_throttle(**kwargs):
+    options = dict(
+        store=MemoryStore(),
+        email_burst=2,
+        email_per_minute=60,
+        ip_burst=3,
+        ip_per_minute=60,
+    )
+    options.update(kwargs)
+    return LoginThrottle(**options)
+
+
+def test__LoginThrottle__check__throttles_per_email(clock):
+    login_throttle = create_throttle()
+
+    assert login_throttle.check('a@example.com', '10.0.0.1') == 0.0
+    assert login_throttle.check('A@example.com ', '10.0.0.2') == 0.0
+    assert login_throttle.check('a@example.com', '10.0.0.3') == pytest.approx(1.0)
+    assert login_throttle.check('b@example.com', '10.0.0.4') == 0.0
+
+    assert login_throttle.throttled_email == 1
+    assert login_throttle.throttled_ip == 0
+    assert login_throttle.allowed == 3
+
+
+def test__LoginThrottle__check__throttles_per_ip(clock):
+    login_throttle = create_throttle()
+
+    for email in ('a@example.com', 'b@example.com', 'c@example.com'):
+        assert login_throttle.check(email, '10.0.0.1') == 0.0
+
+    assert login_throttle.check('d@example.com', '10.0.0.1') > 0
+    assert login_throttle.check('d@example.com', '10.0.0.2') == 0.0
+
+    assert login_throttle.throttled_ip == 1
+
+
+def test__LoginThrottle__check__throttled_ip_does_not_use_up_email(clock):
+    login_throttle = create_throttle(ip_burst=1)
+
+    assert login_throttle.check('a@example.com', '10.0.0.1') == 0.0
+    assert login_throttle.check('a@example.com', '10.0.0.1') > 0
+    assert login_throttle.check('a@example.com', '10.0.0.1') > 0
+
+    # The e-mail's bucket still has a token left
+    assert login_throttle.check('a@example.com', '10.0.0.2') == 0.0
+
+
+def test__LoginThrottle__check__per_ip_disabled__only_throttles_per_email(clock):
+    login_throttle = create_throttle(ip_burst=1, per_ip=False)
+
+    assert login_throttle.check('a@example.com', '10.0.0.1') == 0.0
+    assert login_throttle.check('b@example.com', '10.0.0.1') == 0.0
+    assert login_throttle.check('c@example.com', '10.0.0.1') == 0.0
+
+    assert login_throttle.throttled_ip == 0
+
+
+def test__LoginThrottle__check__disabled__allows_everything(clock):
+    login_throttle = create_throttle(enabled=False)
+
+    for _ in range(10):
+        assert login_throttle.check('a@example.com', '10.0.0.1') == 0.0
+
+
+def test__LoginThrottle__stats__counts_hashes_avoided(clock):
+    login_throttle = create_throttle(email_burst=1)
+    login_throttle.check('a@example.com', '10.0.0.1')
+    login_throttle.check('a@example.com', '10.0.0.1')
+
+    stats = login_throttle.stats()
+
+    assert stats['throttled'] == 1
+    assert stats['hashes_avoided'] == 1
+    assert stats['hash_seconds_avoided'] > 0
@@ -0,0 +1,35 @@
+import threading
+
+from identity.tracing import QueueExporter, TRACE_SPANS_DROPPED
+
+
+class BlockingExporter(object):
+    """
+    Blocks in emit() until released, so the queue is not drained.
+    """
+    def __init__(self):
+        self.released = threading.Event()
+        self.emitted = []
+
+    def emit(self, batch, event=None):
+        self.released.wait(5)
+        self.emitted.extend(batch)
+
+
+def dropped_total():
+    return sum(value for name, labels, value in TRACE_SPANS_DROPPED.samples())
+
+
+def test__QueueExporter__export__queue_full__counts_dropped_spans():
+    exporter = BlockingExporter()
+    queue_exporter = QueueExporter(exporter, max_size=2, batch_size=1)
+    dropped_before = dropped_total()
+
+    queue_exporter.export([object() for _ in range(10)])
+
+    # At most one span was taken by the (blocked) thread, and two queued
+    assert queue_exporter.dropped >= 7
+    assert dropped_total() - dropped_before == queue_exporter.dropped
+    assert queue_exporter.queued + queue_exporter.dropped == 10
+
+    exporter.released.set()
@@ -0,0 +1,61 @@
+"""
+Checks with EXPLAIN that the hot user and token lookups use the
+intended indexes, so a dropped or changed index is caught.
+
+Sequential scans are disabled for the check, so the planner picks an
+index even on a small table; the check fails if it has none to pick.
+
+Runs against the (migrated) database in TEST_DATABASE_URI, and is
+skipped if it isn't set.
+"""
+import os
+
+import pytest
+from sqlalchemy import and_, create_engine, func
+from sqlalchemy.dialects import postgresql
+
+from identity.models import User, UserToken
+
+
+TEST_DATABASE_URI = os.environ.get('TEST_DATABASE_URI')
+
+
+pytestmark = pytest.mark.skipif(
+    not TEST_DATABASE_URI, reason='TEST_DATABASE_URI is not set')
+
+
+CHECKS = (
+    ('user by subject', User, User.subject == 'subject', 'user_subject_key'),
+    ('user by e-mail', User, func.lower(User.email) == 'user@example.com', 'ix_user_email_lower'),
+    ('user by credentials', User, and_(
+        func.lower(User.email) == 'user@example.com',
+        User.active.is_(True),
+        User.disabled.is_(False),
+    ), 'ix_user_email_lower'),
+    ('token by hash', UserToken, UserToken.token_hash == 'hash', 'user_token_token_hash_key'),
+    ('tokens by user', UserToken, UserToken.user_id == 1, 'ix_user_token_user_id'),
+    ('expired tokens', UserToken, UserToken.expires <= func.now(), 'ix_user_token_expires'),
+)
+
+
+@pytest.fixture(scope='module')
+def conn():
+    engine = create_engine(TEST_DATABASE_URI)
+
+    with engine.connect() as conn:
+        conn.execute('SET enable_seqscan = off')
+        yield conn
+
+    engine.dispose()
+
+
+@pytest.mark.parametrize('name, model, criteria, index', CHECKS, ids=[c[0] for c in CHECKS])
+def test__user_lookups__use_intended_index(conn, name, model, criteria, index):
+    statement = model.__table__.select().where(criteria).compile(
+        dialect=postgresql.dialect(),
+        compile_kwargs={'literal_binds': True},
+    )
+
+    plan = '\n'.join(row[0] for row in conn.execute(f'EXPLAIN {statement}'))
+
+    assert index in plan, f'{name} does not use {index}:\n{plan}'